@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks the phases of run.py against synthetic top level directories
+
+Run "python benchmark.py --help" for the options
+"""
+
+import os
+import csv
+import time
+import random
+import shutil
+import hashlib
+import argparse
+from collections import Counter
+
+import run
+
+# The file system functions that are slowed down by inject_latency below
+# os.walk, os.makedirs and the os.path functions call these, so they are slowed down as well
+latency_function_names = ['scandir', 'stat', 'lstat', 'listdir', 'mkdir', 'rename', 'rmdir']
+
+# The number of calls made to each function above on the synthetic share, counted by inject_latency below
+share_calls = Counter()
+
+# This function returns the checksum of the synthetic tif with a given content id
+def synthetic_checksum(content_id):
+    return hashlib.md5(b"%d" % content_id).hexdigest().upper()
+
+# This function generates synthetic top level directories, with the BDR and local checksum files that go with them
+# "base" is the directory everything is written to: the synthetic share is written to base/share and the files run.py
+#   reads and writes to base/work, which is laid out like the directory run.py is run from
+# Each top level directory is a tree "depth" directories deep where every directory has "fanout" sub-directories, and the
+#   tifs are spread over the directories at the bottom of the tree so there are about "tifs" tifs in total
+# "duplicates" is the share of bottom directories that are a copy of another bottom directory, anywhere in the share
+# "injested" is the share of tif contents that are in the BDR. The BDR checksum file also holds as many checksums that are not in the share
+# It returns the number of tifs generated
+def generate_share(base, tifs, stores=2, depth=3, fanout=4, duplicates=0.1, injested=0.3, seed=1):
+    print("\nGenerating %s tifs in %s" % (tifs, base))
+    rnd = random.Random(seed)
+
+    if os.path.isdir(base):
+        shutil.rmtree(base)
+    share = base + '/share/'
+    for directory in ['Results', 'BDR_Checksums', 'Local_Checksums']:
+        os.makedirs(base + '/work/' + directory)
+
+    leaves = []
+    for store in range(stores):
+        indir = "CDI_STORE_%02d" % (store + 1)
+        os.makedirs(base + '/work/Results/' + indir)
+        directories = [indir]
+        for level in range(depth):
+            directories = [directory + "/d%d_%d" % (level, i) for directory in directories for i in range(fanout)]
+        leaves.extend(directories)
+    tifs_per_leaf = max(1, tifs // len(leaves))
+
+    content_id = 0
+    leaf_contents = []
+    files = []
+    for leaf in leaves:
+        if len(leaf_contents) > 0 and rnd.random() < duplicates:
+            contents = rnd.choice(leaf_contents)
+        else:
+            contents = list(range(content_id, content_id + tifs_per_leaf))
+            content_id += tifs_per_leaf
+            leaf_contents.append(contents)
+
+        os.makedirs(share + leaf)
+        for i, content in enumerate(contents):
+            filepath = leaf + "/img_%05d.tif" % i
+            with open(share + filepath, 'wb') as f:
+                f.write(b"%d" % content)
+            files.append((filepath, content))
+
+    with open(base + '/work/Local_Checksums/benchmark_hash_tiff_only.csv', 'w', newline='') as f:
+        f.write("Synthetic local checksums\n\n")
+        for filepath, content in files:
+            f.write("2019-01-01 00:00 " + filepath.replace("/", "\\") + " " + synthetic_checksum(content) + "\n")
+
+    with open(base + '/work/BDR_Checksums/checksum_data_3.csv', 'w', newline='') as f:
+        writer = csv.writer(f, delimiter=',')
+        writer.writerow(["pid", "name", "format", "size", "checksum"])
+        bdr_number = 0
+        for content in range(content_id):
+            if rnd.random() < injested:
+                writer.writerow(["bdr:%d" % bdr_number, "img.tif", "image/tiff", 0, synthetic_checksum(content).lower()])
+                bdr_number += 1
+        for content in range(content_id, 2*content_id):
+            writer.writerow(["bdr:%d" % bdr_number, "img.tif", "image/tiff", 0, synthetic_checksum(content).lower()])
+            bdr_number += 1
+
+    return len(files)
+
+# This function returns a version of a file system function that waits "latency" seconds before each call on the share,
+#   to mimic the round-trip of a network file system
+def add_latency(function, name, share, latency):
+    def delayed(path, *args, **kwargs):
+        if isinstance(path, str) and path.startswith(share):
+            share_calls[name] += 1
+            time.sleep(latency)
+        return function(path, *args, **kwargs)
+    return delayed
+
+# This function slows down the file system functions listed above for paths on the synthetic share
+# It returns the original functions, to be restored with remove_latency below
+def inject_latency(share, latency):
+    originals = dict()
+    for name in latency_function_names:
+        originals[name] = getattr(os, name)
+        setattr(os, name, add_latency(originals[name], name, share, latency))
+    return originals
+
+# This function restores the file system functions replaced by inject_latency above
+def remove_latency(originals):
+    for name in originals:
+        setattr(os, name, originals[name])
+
+# This function runs one phase and records how long it took and how many calls it made to the share
+# It returns the value returned by the phase
+def time_phase(results, tifs, latency, name, function, *args):
+    share_calls.clear()
+    start = time.perf_counter()
+    value = function(*args)
+    elapsed = time.perf_counter() - start
+    results.append([tifs, latency, name, "%.3f" % elapsed, sum(share_calls.values())])
+    print("\n%s: %.3f seconds, %s share calls" % (name, elapsed, sum(share_calls.values())))
+    return value
+
+# This function benchmarks the phases of run.py against a synthetic share generated by generate_share above
+# The functions the command line runs are timed (the BDR digest index, compact checksums, analyze_dir_collisions and
+#   process_stores) along with the older dictionary versions they replaced, so both can be compared
+# "latency" is the time in seconds added to each file system call on the share
+# "threads" is the number of threads used by the threaded folder scan and the mover
+# "workers" is the number of processes used by analyze_dir_collisions and process_stores. The share calls of worker processes
+#   are not counted
+# It returns a list of [tifs, latency, phase, seconds, share calls] rows
+def benchmark_share(base, latency=0.0, threads=8, workers=4):
+    results = []
+    base = os.path.abspath(base)
+    with open(base + '/work/Local_Checksums/benchmark_hash_tiff_only.csv') as f:
+        tifs = sum(1 for line in f) - 2
+
+    cwd = os.getcwd()
+    share_root = run.share_root
+    local_list_file_names = run.local_list_file_names
+    os.chdir(base + '/work')
+    run.share_root = base + '/share/'
+    run.local_list_file_names = ['benchmark_hash_tiff_only.csv']
+    originals = inject_latency(run.share_root, latency)
+    try:
+        bdr_checksums = time_phase(results, tifs, latency, "get_bdr_checksums", run.get_bdr_checksums)
+        time_phase(results, tifs, latency, "compile_bdr_index", run.compile_bdr_index)
+        bdr_index = time_phase(results, tifs, latency, "open_bdr_index", run.open_bdr_index)
+
+        time_phase(results, tifs, latency, "get_folder_structures (os.walk)", run.get_folder_structures, False, False)
+        folder_structures = time_phase(results, tifs, latency, "get_folder_structures (%s threads)" % threads, run.get_folder_structures, False, False, threads)
+        time_phase(results, tifs, latency, "get_folder_structures (incremental)", run.get_folder_structures, False, False, threads, True)
+
+        local_checksums_fwd, local_checksums_bwd = time_phase(results, tifs, latency, "get_local_checksums", run.get_local_checksums, folder_structures)
+        compact_fwd, compact_bwd = time_phase(results, tifs, latency, "get_local_checksums (compact)", run.get_local_checksums, folder_structures, False, workers, None, True)
+
+        time_phase(results, tifs, latency, "analyze_dir_bdr_collisions", run.analyze_dir_bdr_collisions, folder_structures, local_checksums_bwd, bdr_checksums)
+        time_phase(results, tifs, latency, "analyze_dir_local_collisions", run.analyze_dir_local_collisions, folder_structures, local_checksums_fwd, local_checksums_bwd)
+        time_phase(results, tifs, latency, "analyze_dir_collisions (bdr index)", run.analyze_dir_collisions, folder_structures, compact_fwd, compact_bwd, bdr_index, 0)
+        time_phase(results, tifs, latency, "analyze_dir_collisions (%s workers)" % workers, run.analyze_dir_collisions, folder_structures, compact_fwd, compact_bwd, bdr_index, workers)
+
+        time_phase(results, tifs, latency, "process_stores (%s workers)" % workers, run.process_stores, workers, False, threads, False, True)
+
+        time_phase(results, tifs, latency, "move_duplicate_directories", run.move_duplicate_directories, local_checksums_bwd, folder_structures, False, threads)
+    finally:
+        remove_latency(originals)
+        os.chdir(cwd)
+        run.share_root = share_root
+        run.local_list_file_names = local_list_file_names
+    return results
+
+# This function writes the rows returned by benchmark_share above to a csv file
+def save_results(file_name, results):
+    with open(file_name, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile, delimiter=',')
+        writer.writerow(["Tifs", "Latency", "Phase", "Seconds", "Share Calls"])
+        for row in results:
+            writer.writerow(row)
+    print("\nResults saved to " + file_name)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Benchmark the phases of run.py against synthetic top level directories.")
+    parser.add_argument('--scales', default="10000,100000", help="A comma separated list of the number of tifs to generate. Default: 10000,100000")
+    parser.add_argument('--stores', type=int, default=2, help="The number of top level directories. Default: 2")
+    parser.add_argument('--depth', type=int, default=3, help="The depth of each top level directory. Default: 3")
+    parser.add_argument('--fanout', type=int, default=4, help="The number of sub-directories of each directory. Default: 4")
+    parser.add_argument('--duplicates', type=float, default=0.1, help="The share of directories that are duplicates. Default: 0.1")
+    parser.add_argument('--injested', type=float, default=0.3, help="The share of tifs that are in the BDR. Default: 0.3")
+    parser.add_argument('--latency', type=float, default=0.0, help="Milliseconds added to each file system call on the share. Default: 0")
+    parser.add_argument('--threads', type=int, default=8, help="The number of threads used to scan and move. Default: 8")
+    parser.add_argument('--workers', type=int, default=4, help="The number of processes used to analyze and scan each top level directory. Default: 4")
+    parser.add_argument('--base', default="Benchmark", help="The directory the synthetic files are written to. Default: Benchmark")
+    parser.add_argument('--output', default="benchmark_results.csv", help="The csv file the timings are written to. Default: benchmark_results.csv")
+    args = parser.parse_args()
+
+    results = []
+    for scale in args.scales.split(","):
+        base = args.base + "/" + scale.strip()
+        generate_share(base, int(scale), args.stores, args.depth, args.fanout, args.duplicates, args.injested)
+        results.extend(benchmark_share(base, args.latency / 1000, args.threads, args.workers))
+
+    print("\n%10s %8s  %-40s %10s %12s" % ("Tifs", "Latency", "Phase", "Seconds", "Share Calls"))
+    for tifs, latency, name, seconds, calls in results:
+        print("%10s %8s  %-40s %10s %12s" % (tifs, latency, name, seconds, calls))
+    save_results(args.output, results)
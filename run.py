@@ -6,7 +6,41 @@ Created on Wed Feb 27 13:37:29 2019
 """
 
 import os
+import sys
 import csv
+import math
+import mmap
+import gzip
+import time
+import heapq
+import random
+import array
+import struct
+import hashlib
+import filecmp
+import json
+import pickle
+import sqlite3
+import stat
+import argparse
+import builtins
+import tempfile
+import threading
+import socketserver
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import chain, compress
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+# resource is only available on Unix, peak_memory reads the peak memory use on Windows with ctypes instead
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# The root of the network share that holds the top level directories
+share_root = '//files.brown.edu/DFS/Library_DPS/'
 
 # A list of the local checksum files
 local_list_file_names = [#'carter_hash_tiff_only.csv',
@@ -24,6 +58,24 @@ local_list_file_names = [#'carter_hash_tiff_only.csv',
                          'lib_store_08_checkme_hash_tiff_only.csv',
                          'mjp_hash_tiff_only.csv']    
 
+# The SQLite index that caches the CSV files, see open_index
+index_file_name = 'dps_index.sqlite'
+
+# The memory-mapped BDR checksum index, see compile_bdr_index
+bdr_index_file_name = 'BDR_Checksums/checksum_data_3.idx'
+
+# The directory that holds move plans and their journals, see execute_move_plan
+journal_dir_name = 'Journals'
+
+# The directory that holds the cached results of the stages run by run_phases, see save_artifact
+cache_dir_name = 'Cache'
+
+# The directory that holds the metrics and profiles of each run of run_phases, see save_metrics
+metrics_dir_name = 'Metrics'
+
+# The file that holds checksums computed by compute_checksums, it is not one of the local checksum files listed above
+hash_cache_file_name = 'Local_Checksums/computed_hash_cache.csv'
+
 # This function checks if a given file is a tif
 # It also removes non ascii characters from any names
 # It returns the (potentially modified) file name if it is a tif
@@ -48,39 +100,335 @@ def check_filename(filename, verbose=True):
     
     return filename
     
-# This function parses the data from the BDR checksum CSV file
-# It returns a dictionary: bdr_checksums
-#   The keys are checksums and the values are the BDR numbers
-def get_bdr_checksums():
-    print("Reading BDR Checksums")
-    bdr_checksums = dict()
+# This function reads the rows of the BDR checksum CSV file
+# It yields a (checksum, BDR number) tuple for each row
+def read_bdr_checksum_rows():
     with open('BDR_Checksums/checksum_data_3.csv') as csv_file:
         csv_reader = csv.reader(csv_file, delimiter=',')
         line_count = 0
-        collisions = 0
         for row in csv_reader:
             if line_count == 0: pass
             else:
-                checksum = row[4].upper()
-                bdr_number = row[0]
-                if checksum not in bdr_checksums:
-                    bdr_checksums[checksum] = [bdr_number]                   
-                else:
-                    bdr_checksums[checksum].append(bdr_number)
-                    collisions += 1
+                yield row[4].upper(), row[0]
             line_count += 1
-        print("Processed %s lines. %s collisions." % (line_count, collisions))  
+
+# This function converts a hex checksum to the 16 byte digest used by compact dictionaries
+# Checksums that are not valid hex are returned unchanged so they still work as keys
+def checksum_digest(checksum):
+    try:
+        return bytes.fromhex(checksum)
+    except ValueError:
+        return checksum
+
+# This function returns the values stored for a key of a checksum dictionary as a list
+# Compact dictionaries store a single value on its own and only use a list when there are several
+def checksum_entries(checksums, checksum):
+    value = checksums[checksum]
+    return value if isinstance(value, list) else [value]
+
+# This function parses the data from the BDR checksum CSV file
+# If "compact" is set, checksums are stored as 16 byte digests (see checksum_digest above) and a checksum with a single
+#   BDR number stores it on its own instead of in a list. Use checksum_entries above to read the BDR numbers
+# It returns a dictionary: bdr_checksums
+#   The keys are checksums and the values are the BDR numbers
+def get_bdr_checksums(compact=False):
+    print("Reading BDR Checksums")
+    
+    bdr_checksums = dict()
+    line_count = 1
+    collisions = 0
+    for checksum, bdr_number in read_bdr_checksum_rows():
+        if compact:
+            checksum = checksum_digest(checksum)
+            if checksum not in bdr_checksums:
+                bdr_checksums[checksum] = bdr_number
+            else:
+                if not isinstance(bdr_checksums[checksum], list):
+                    bdr_checksums[checksum] = [bdr_checksums[checksum]]
+                bdr_checksums[checksum].append(bdr_number)
+                collisions += 1
+        elif checksum not in bdr_checksums:
+            bdr_checksums[checksum] = [bdr_number]                   
+        else:
+            bdr_checksums[checksum].append(bdr_number)
+            collisions += 1
+        line_count += 1
+    print("Processed %s lines. %s collisions." % (line_count, collisions))  
     return bdr_checksums
 
-# This function parses the data from the file system checksum files listed above
-# Only files that are found in the file system are listed
-# It takes a folder structure dictionary
-# It returns two dictionaries
-#   local_checksums_fwd has checksums as keys and lists of files with that checksum as values
-#   local_checksums_bdw has a key for each file name with its checksum as value
-def get_local_checksums(folder_structures):
-    print("\nReading Local Checksums")
+# This function compiles the BDR checksum CSV file into a sorted binary file that can be memory-mapped by BDRDigestIndex below
+# The file contains a header, the sorted 16 byte digests, the offsets of each BDR number and the BDR numbers themselves
+#   Checksums that appear more than once are stored once per BDR number, in the order of the CSV file
+# The size and modification time of the CSV file are saved in the header so open_bdr_index can tell when it is out of date
+def compile_bdr_index():
+    print("Compiling BDR Checksums into " + bdr_index_file_name)
+    st = os.stat('BDR_Checksums/checksum_data_3.csv')
+    
+    rows = []
+    invalid = 0
+    for checksum, bdr_number in read_bdr_checksum_rows():
+        digest = checksum_digest(checksum)
+        if isinstance(digest, bytes) and len(digest) == 16:
+            rows.append((digest, len(rows), bdr_number.encode('utf-8')))
+        else:
+            invalid += 1
+    rows.sort()
+    
+    offsets = array.array('Q', [0])
+    for digest, position, bdr_number in rows:
+        offsets.append(offsets[-1] + len(bdr_number))
+    if sys.byteorder != 'little':
+        offsets.byteswap()
+    
+    with open(bdr_index_file_name + '.tmp', 'wb') as f:
+        f.write(struct.pack('<8sQQQ', b'BDRIDX01', len(rows), st.st_size, st.st_mtime_ns))
+        f.write(b"".join(row[0] for row in rows))
+        f.write(offsets.tobytes())
+        f.write(b"".join(row[2] for row in rows))
+    os.replace(bdr_index_file_name + '.tmp', bdr_index_file_name)
+    
+    print("Compiled %s checksums. %s invalid checksums skipped." % (len(rows), invalid))
+
+# This class answers BDR checksum lookups from the file written by compile_bdr_index above
+# The file is memory-mapped, so nothing is parsed when it is opened and worker processes that open the same file
+#   share it through the page cache. Only the file path is pickled when it is sent to another process
+# It can be used in place of the bdr_checksums dictionary: "checksum in index" and index[checksum] work with hex
+#   checksums or 16 byte digests, and index[checksum] returns the list of BDR numbers
+class BDRDigestIndex:
+    
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, self.source_size, self.source_mtime = struct.unpack_from('<8sQQQ', self.map, 0)
+        if magic != b'BDRIDX01':
+            raise ValueError("Not a BDR index file: " + path)
+        self.digests = 32
+        self.offsets = self.digests + 16*self.count
+        self.numbers = self.offsets + 8*(self.count + 1)
+    
+    def __getstate__(self):
+        return self.path
+    
+    def __setstate__(self, path):
+        self.__init__(path)
+    
+    def __len__(self):
+        return self.count
+    
+    def close(self):
+        self.map.close()
+        self.file.close()
+    
+    # This returns the 16 byte digest of a checksum, or None if the checksum is not valid
+    def digest(self, checksum):
+        if isinstance(checksum, str):
+            checksum = checksum_digest(checksum)
+        if isinstance(checksum, bytes) and len(checksum) == 16:
+            return checksum
+        return None
+    
+    # This returns the position of the first digest that is not less than the given digest, starting the search at "lo"
+    def lower_bound(self, digest, lo=0):
+        hi = self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = self.digests + 16*mid
+            if self.map[start:start+16] < digest:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+    
+    # This returns the BDR numbers stored from "position" onwards for the given digest
+    def bdr_numbers(self, digest, position):
+        bdr_numbers = []
+        while position < self.count and self.map[self.digests+16*position:self.digests+16*position+16] == digest:
+            start, end = struct.unpack_from('<QQ', self.map, self.offsets + 8*position)
+            bdr_numbers.append(self.map[self.numbers+start:self.numbers+end].decode('utf-8'))
+            position += 1
+        return bdr_numbers
+    
+    def __contains__(self, checksum):
+        digest = self.digest(checksum)
+        if digest is None:
+            return False
+        position = self.lower_bound(digest)
+        return position < self.count and self.map[self.digests+16*position:self.digests+16*position+16] == digest
+    
+    def __getitem__(self, checksum):
+        digest = self.digest(checksum)
+        bdr_numbers = [] if digest is None else self.bdr_numbers(digest, self.lower_bound(digest))
+        if len(bdr_numbers) == 0:
+            raise KeyError(checksum)
+        return bdr_numbers
+    
+    def get(self, checksum, default=None):
+        try:
+            return self[checksum]
+        except KeyError:
+            return default
+    
+    # This looks up many checksums at once
+    # The digests are sorted so each binary search starts where the previous one ended
+    # It returns a dictionary with the checksums that were found as keys and lists of BDR numbers as values
+    def lookup_many(self, checksums):
+        queries = []
+        for checksum in set(checksums):
+            digest = self.digest(checksum)
+            if digest is not None:
+                queries.append((digest, checksum))
+        queries.sort()
+        
+        found = dict()
+        position = 0
+        for digest, checksum in queries:
+            position = self.lower_bound(digest, position)
+            bdr_numbers = self.bdr_numbers(digest, position)
+            if len(bdr_numbers) > 0:
+                found[checksum] = bdr_numbers
+        return found
+
+# This function opens the BDR digest index, compiling it first if it is missing or the BDR checksum CSV file has changed
+# It returns a BDRDigestIndex
+def open_bdr_index():
+    print("Reading BDR Checksums")
+    st = os.stat('BDR_Checksums/checksum_data_3.csv')
+    if os.path.isfile(bdr_index_file_name):
+        bdr_index = BDRDigestIndex(bdr_index_file_name)
+        if bdr_index.source_size == st.st_size and bdr_index.source_mtime == st.st_mtime_ns:
+            print("Opened %s checksums" % len(bdr_index))
+            return bdr_index
+        bdr_index.close()
+    compile_bdr_index()
+    return BDRDigestIndex(bdr_index_file_name)
+
+# This function looks up the checksums of a set of files in the BDR
+# bdr_checksums can be a dictionary from get_bdr_checksums or a BDRDigestIndex, which looks them up in one batch
+# It returns a dictionary with the checksums that are in the BDR as keys and lists of BDR numbers as values
+def lookup_bdr_checksums(bdr_checksums, checksums):
+    if isinstance(bdr_checksums, BDRDigestIndex):
+        return bdr_checksums.lookup_many(checksums)
+    found = dict()
+    for checksum in checksums:
+        if checksum in bdr_checksums:
+            found[checksum] = checksum_entries(bdr_checksums, checksum)
+    return found
+
+# This function returns the set of checksums of the tifs in a folder structure, see get_folder_structures below
+def get_folder_checksums(folder_structure, local_checksums):
+    checksums = set()
+    for directory in folder_structure:
+        for filepath in folder_structure[directory]['tifs']:
+            checksum = local_checksums.get(filepath)
+            if checksum is not None:
+                checksums.add(checksum)
+    return checksums
+
+# This function computes the MD5 checksum of a single file
+# The file is read in large blocks into a reused buffer to keep the number of network reads low
+# It returns a tuple (checksum, size) with the checksum in upper case, or (None, 0) if the file could not be read
+def hash_file(path, block_size=8*1024*1024):
+    md5 = hashlib.md5()
+    size = 0
+    buffer = bytearray(block_size)
+    view = memoryview(buffer)
+    try:
+        with open(path, 'rb', buffering=0) as f:
+            while True:
+                length = f.readinto(buffer)
+                if not length:
+                    break
+                md5.update(view[:length])
+                size += length
+    except OSError:
+        return None, 0
+    return md5.hexdigest().upper(), size
+
+# This function gets the size and modification time of a file for compute_checksums below
+# It returns a tuple (filepath, size, mtime) or (filepath, None, None) if the file could not be read
+def stat_file(filepath):
+    try:
+        st = os.stat(share_root + filepath)
+    except OSError:
+        return filepath, None, None
+    return filepath, st.st_size, st.st_mtime_ns
+
+# This function reads the checksums computed by previous runs of compute_checksums
+# It returns a dictionary: hash_cache
+#   The keys are file paths and the values are (size, mtime, checksum) tuples
+def read_hash_cache():
+    hash_cache = dict()
+    if os.path.isfile(hash_cache_file_name):
+        with open(hash_cache_file_name) as csv_file:
+            csv_reader = csv.reader(csv_file, delimiter=',')
+            line_count = 0
+            for row in csv_reader:
+                if line_count > 0:
+                    hash_cache[row[0]] = (int(row[1]), int(row[2]), row[3])
+                line_count += 1
+    return hash_cache
+
+# This function saves the checksums computed by compute_checksums so later runs only hash new or changed files
+def save_hash_cache(hash_cache):
+    with open(hash_cache_file_name, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile, delimiter=',')
+        writer.writerow(["File", "Size", "Modified", "Checksum"])
+        for filepath in hash_cache:
+            size, mtime, checksum = hash_cache[filepath]
+            writer.writerow([filepath, size, mtime, checksum])
+
+# This function computes checksums for files that are not in the local checksum files
+# Files are stat'ed by a pool of threads and files that are new or have changed since the last run are hashed by a pool of "workers" processes
+# Results are saved in the hash cache, keyed by path, size and modification time
+# If a "hash_cache" dictionary from read_hash_cache is given it is used and updated instead, and the caller saves it
+# It takes a list of file paths relative to the share
+# It returns a dictionary with file paths as keys and checksums as values, files that could not be read are left out
+def compute_checksums(filepaths, workers=4, hash_cache=None):
+    print("Computing checksums for %s files" % len(filepaths))
+    
+    save = hash_cache is None
+    if save:
+        hash_cache = read_hash_cache()
+    checksums = dict()
+    to_hash = []
+    
+    with ThreadPoolExecutor(max_workers=max(workers, 8)) as executor:
+        for filepath, size, mtime in executor.map(stat_file, filepaths):
+            if size is None:
+                print("Error: File not found")
+                print(filepath)
+            elif filepath in hash_cache and hash_cache[filepath][0] == size and hash_cache[filepath][1] == mtime:
+                checksums[filepath] = hash_cache[filepath][2]
+            else:
+                to_hash.append((filepath, size, mtime))
+    
+    print("%s checksums cached, hashing %s files" % (len(checksums), len(to_hash)))
+    
+    if len(to_hash) > 0:
+        start = time.time()
+        total_bytes = 0
+        with ProcessPoolExecutor(max_workers=max(1, workers)) as executor:
+            results = executor.map(hash_file, [share_root + filepath for filepath, size, mtime in to_hash], chunksize=16)
+            for (filepath, size, mtime), (checksum, length) in zip(to_hash, results):
+                if checksum is None:
+                    print("Error: Could not read file")
+                    print(filepath)
+                else:
+                    checksums[filepath] = checksum
+                    hash_cache[filepath] = (size, mtime, checksum)
+                    total_bytes += length
+        elapsed = time.time() - start
+        
+        print("Hashed %.1f MB in %.1f seconds: %.1f MB/s with %s workers" % (total_bytes/(1024*1024), elapsed, total_bytes/(1024*1024)/max(elapsed, 1e-6), workers))
+        if save:
+            save_hash_cache(hash_cache)
     
+    return checksums
+
+# This function parses the data from the file system checksum files listed above
+# It returns a dictionary with file names as keys and checksums as values
+def read_local_checksum_files():
     file_checksums = dict()
     line_count = 0
     for file_name in local_list_file_names:
@@ -94,9 +442,7 @@ def get_local_checksums(folder_structures):
                         pass
                 else:
                     
-                    row_string = ""
-                    for piece in row:
-                        row_string += piece
+                    row_string = "".join(row)
                     checksum = row_string[-32:].upper()
                     filename = check_filename(row_string[17:-33])
                     
@@ -104,6 +450,35 @@ def get_local_checksums(folder_structures):
                         file_checksums[filename] = checksum
                         
                 line_count += 1
+    return file_checksums
+
+# This function matches the local checksums to the files in the file system
+# Only files that are found in the file system are listed
+# It takes a folder structure dictionary
+# If "compute" is set, checksums of tifs missing from the local checksum files are computed with compute_checksums above
+# If an "index" connection is given (see open_index below) the local checksum files are read from the index instead
+# If "compact" is set, checksums are stored as 16 byte digests (see checksum_digest above), a checksum with a single file
+#   stores it on its own instead of in a list. Use checksum_entries above to read the files
+# It returns two dictionaries
+#   local_checksums_fwd has checksums as keys and lists of files with that checksum as values
+#   local_checksums_bdw has a key for each file name with its checksum as value
+def get_local_checksums(folder_structures, compute=False, workers=4, index=None, compact=False):
+    print("\nReading Local Checksums")
+    
+    if index is not None:
+        index_local_checksums(index)
+        file_checksums = dict(index.execute("SELECT path, checksum FROM local_checksums"))
+    else:
+        file_checksums = read_local_checksum_files()
+    
+    if compute:
+        missing = []
+        for topdir in folder_structures:
+            for directory in folder_structures[topdir]:
+                for filepath in folder_structures[topdir][directory]['tifs']:
+                    if filepath not in file_checksums:
+                        missing.append(filepath)
+        file_checksums.update(compute_checksums(missing, workers))
        
     local_checksums_fwd = dict()
     local_checksums_bwd = dict()
@@ -111,26 +486,449 @@ def get_local_checksums(folder_structures):
     found = 0
     total = 0
     for topdir in folder_structures:
-        for directory in folder_structures[topdir]:
-            for filepath in folder_structures[topdir][directory]['tifs']:
-                total += 1
-                if filepath in file_checksums:
-                    found += 1
-                    
-                    checksum = file_checksums[filepath]
-                    if checksum not in local_checksums_fwd:
-                        local_checksums_fwd[checksum] = [filepath]                   
-                    else:
-                        local_checksums_fwd[checksum].append(filepath)
-                else:
-                    checksum = None
-                    
-                local_checksums_bwd[filepath] = checksum                    
+        counts = match_local_checksums(folder_structures[topdir], file_checksums, local_checksums_fwd, local_checksums_bwd, compact)
+        found += counts[0]
+        total += counts[1]
                     
     print("Found %s of %s" % (found, total))
     
     return local_checksums_fwd, local_checksums_bwd
 
+# This function adds the tifs of the folder structure of one top level directory to the dictionaries made by get_local_checksums above
+# "file_checksums" is a dictionary with file names as keys and checksums as values
+# It returns a tuple (found, total) with the number of tifs with a checksum and the number of tifs
+def match_local_checksums(folder_structure, file_checksums, local_checksums_fwd, local_checksums_bwd, compact=False):
+    found = 0
+    total = 0
+    for directory in folder_structure:
+        for filepath in folder_structure[directory]['tifs']:
+            total += 1
+            if filepath in file_checksums:
+                found += 1
+                add_local_checksum(local_checksums_fwd, local_checksums_bwd, filepath, file_checksums[filepath], compact)
+            else:
+                local_checksums_bwd[filepath] = None
+    return found, total
+
+# This function merges the checksum dictionaries of one top level directory into the dictionaries made by get_local_checksums above
+# Top level directories must be merged in the order get_local_checksums reads them, so the merged dictionaries are the same,
+#   key order and list order included. "compact" must match the flag all the dictionaries were made with
+def merge_local_checksums(local_checksums_fwd, local_checksums_bwd, store_fwd, store_bwd, compact=False):
+    merged = dict()
+    for checksum in store_fwd.keys() & local_checksums_fwd.keys():
+        merged[checksum] = checksum_entries(local_checksums_fwd, checksum) + checksum_entries(store_fwd, checksum)
+    local_checksums_fwd.update(store_fwd)
+    local_checksums_fwd.update(merged)
+    local_checksums_bwd.update(store_bwd)
+
+# This function adds the checksum of a file to the dictionaries made by get_local_checksums above
+# "compact" must match the "compact" flag the dictionaries were made with
+def add_local_checksum(local_checksums_fwd, local_checksums_bwd, filepath, checksum, compact=False):
+    if compact:
+        checksum = checksum_digest(checksum)
+        if checksum not in local_checksums_fwd:
+            local_checksums_fwd[checksum] = filepath
+        elif not isinstance(local_checksums_fwd[checksum], list):
+            local_checksums_fwd[checksum] = [local_checksums_fwd[checksum], filepath]
+        else:
+            local_checksums_fwd[checksum].append(filepath)
+    elif checksum not in local_checksums_fwd:
+        local_checksums_fwd[checksum] = [filepath]                   
+    else:
+        local_checksums_fwd[checksum].append(filepath)
+    local_checksums_bwd[filepath] = checksum
+
+# This function computes the MD5 checksum of the first and last "length" bytes of a file for find_missing_checksums below
+# Files no longer than twice "length" are read whole, so the partial checksum is their full checksum
+# It returns a tuple (filepath, partial checksum, full checksum or None), or (filepath, None, None) if the file could not be read
+def hash_file_ends(filepath, size, length=64*1024):
+    try:
+        with open(share_root + filepath, 'rb') as f:
+            if size <= 2*length:
+                checksum = hashlib.md5(f.read()).hexdigest().upper()
+                return filepath, checksum, checksum
+            head = f.read(length)
+            f.seek(size - length)
+            tail = f.read(length)
+    except OSError:
+        return filepath, None, None
+    return filepath, hashlib.md5(head + tail).hexdigest().upper(), None
+
+# This function finds the checksums of tifs missing from the local checksums that could be duplicates of other tifs
+# Hashing every such tif over the network is expensive, so the candidates are narrowed down in tiers
+#   1. Tifs are grouped by size, using the sizes read during the folder scan where they are known. Only sizes shared
+#      by a tif without a checksum and at least one other tif are kept
+#   2. The first and last "length" bytes of those tifs are hashed, and only tifs that still match another tif are kept
+#   3. Only the tifs without a checksum that are left are hashed in full, with compute_checksums above
+# Tifs with a checksum only take part if their size was read during the folder scan
+# The new checksums are added to local_checksums_fwd and local_checksums_bwd, "compact" must match the flag they were made with
+def find_missing_checksums(folder_structures, local_checksums_fwd, local_checksums_bwd, compact=False, length=64*1024, workers=8):
+    print("\nFinding checksums of possible duplicates")
+    
+    sizes = dict()
+    missing = []
+    for topdir in folder_structures:
+        for directory in folder_structures[topdir]:
+            entry = folder_structures[topdir][directory]
+            for i, filepath in enumerate(entry['tifs']):
+                size = entry['sizes'][i] if 'sizes' in entry else None
+                if local_checksums_bwd.get(filepath) is None:
+                    missing.append(filepath)
+                if size is not None:
+                    sizes[filepath] = size
+    
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for filepath, size, mtime in executor.map(stat_file, [i for i in missing if i not in sizes]):
+            if size is not None:
+                sizes[filepath] = size
+    
+    size_groups = dict()
+    for filepath in sizes:
+        if sizes[filepath] not in size_groups:
+            size_groups[sizes[filepath]] = []
+        size_groups[sizes[filepath]].append(filepath)
+    
+    missing_set = set(missing)
+    candidates = []
+    for size in size_groups:
+        if len(size_groups[size]) > 1 and any(i in missing_set for i in size_groups[size]):
+            candidates.extend(size_groups[size])
+    print("%s tifs without checksums, %s tifs share a size with one" % (len(missing), len(candidates)))
+    
+    partial_groups = dict()
+    full_checksums = dict()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for filepath, partial, full in executor.map(hash_file_ends, candidates, [sizes[i] for i in candidates], [length]*len(candidates)):
+            if partial is None:
+                continue
+            key = (sizes[filepath], partial)
+            if key not in partial_groups:
+                partial_groups[key] = []
+            partial_groups[key].append(filepath)
+            if full is not None:
+                full_checksums[filepath] = full
+    
+    to_hash = []
+    found = dict()
+    for key in partial_groups:
+        if len(partial_groups[key]) > 1:
+            for filepath in partial_groups[key]:
+                if filepath in missing_set:
+                    if filepath in full_checksums:
+                        found[filepath] = full_checksums[filepath]
+                    else:
+                        to_hash.append(filepath)
+    print("%s tifs still match another tif, %s need a full checksum" % (len(found) + len(to_hash), len(to_hash)))
+    
+    if len(to_hash) > 0:
+        found.update(compute_checksums(to_hash, workers))
+    
+    for filepath in found:
+        add_local_checksum(local_checksums_fwd, local_checksums_bwd, filepath, found[filepath], compact)
+    print("Found %s checksums" % len(found))
+
+# This function saves the folder structure of one top level directory to its folder_structure.csv file
+# The file is only replaced if its contents changed, so its modification time shows when the folder structure last changed
+#   and the stages that read it are only run again when it did, see file_stats below
+# If an "index" connection is given the folder structure is also saved to the index
+def save_folder_structure(indir, folder_structure, index=None):
+    name = "Results/" + indir + "/folder_structure.csv"
+    with open(name + '.tmp', 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile, delimiter=',')
+        writer.writerow(["Directory", "Error", "Contains Directories", "Total Files", "Total Tifs", "Modified", "Entries", "Tifs"])      
+        for directory in folder_structure:
+            mtime = folder_structure[directory].get('mtime')
+            entries = folder_structure[directory].get('entries')
+            row = ["".join(i for i in directory if ord(i)<128), folder_structure[directory]['error'], folder_structure[directory]['super_dir'], folder_structure[directory]['total_files'], folder_structure[directory]['total_tifs'], "" if mtime is None else mtime, "" if entries is None else entries] + folder_structure[directory]['tifs']
+            writer.writerow(row)        
+    if os.path.isfile(name) and filecmp.cmp(name + '.tmp', name, shallow=False):
+        os.remove(name + '.tmp')
+    else:
+        os.replace(name + '.tmp', name)
+    
+    if index is not None:
+        index_folder_structure(index, indir, folder_structure)
+
+# This function reads the folder structure of one top level directory from its folder_structure.csv file
+# Files written before the "Modified" and "Entries" columns were added are read with both values set to None
+# If an "index" connection is given and folder_structure.csv has not changed since it was imported, it is read from the index
+def read_folder_structure(indir, index=None):
+    if index is not None and index_source_current(index, "Results/" + indir + "/folder_structure.csv"):
+        return load_folder_structure_from_index(index, indir)
+    
+    folder_structure = dict()
+    with open("Results/" + indir + "/folder_structure.csv") as csv_file:
+        csv_reader = csv.reader(csv_file, delimiter=',')
+        tifs_column = 5
+        line_count = 0
+        for row in csv_reader:
+            if line_count < 1: 
+                if len(row) > 6 and row[5] == "Modified":
+                    tifs_column = 7
+            else:
+                directory = row[0]
+                
+                folder_structure[directory] = dict()
+                folder_structure[directory]['error'] = int(row[1])
+                folder_structure[directory]['super_dir'] = int(row[2])
+                folder_structure[directory]['total_files'] = int(row[3])
+                folder_structure[directory]['total_tifs'] = int(row[4])
+                folder_structure[directory]['mtime'] = int(row[5]) if tifs_column == 7 and row[5] != "" else None
+                folder_structure[directory]['entries'] = int(row[6]) if tifs_column == 7 and row[6] != "" else None
+                folder_structure[directory]['tifs'] = row[tifs_column:]
+                
+            line_count += 1
+    
+    if index is not None:
+        index_folder_structure(index, indir, folder_structure)
+    return folder_structure
+
+# This function opens the SQLite index that holds the data of the local checksum files and folder_structure.csv files
+# The index is a cache of the CSV files: each table records the size and modification time of the CSV files
+#   it was imported from, and is re-imported automatically when they change
+# The BDR checksums are not in the index, they are compiled into their own digest index, see compile_bdr_index above
+# It returns a sqlite3 connection
+def open_index():
+    index = sqlite3.connect(index_file_name)
+    index.executescript("""
+        CREATE TABLE IF NOT EXISTS sources (name TEXT PRIMARY KEY, size INTEGER, mtime INTEGER);
+        DROP TABLE IF EXISTS bdr_checksums;
+        CREATE TABLE IF NOT EXISTS local_checksums (path TEXT PRIMARY KEY, checksum TEXT);
+        CREATE INDEX IF NOT EXISTS local_checksums_checksum ON local_checksums (checksum);
+        CREATE TABLE IF NOT EXISTS directories (store TEXT, path TEXT PRIMARY KEY, position INTEGER, error INTEGER, super_dir INTEGER,
+                                                total_files INTEGER, total_tifs INTEGER, mtime INTEGER, entries INTEGER);
+        CREATE INDEX IF NOT EXISTS directories_store ON directories (store, position);
+        CREATE TABLE IF NOT EXISTS files (path TEXT, directory TEXT, position INTEGER, size INTEGER);
+        CREATE INDEX IF NOT EXISTS files_directory ON files (directory, position);
+        CREATE INDEX IF NOT EXISTS files_path ON files (path);
+    """)
+    return index
+
+# This function checks whether a CSV file has changed since it was imported into the index
+def index_source_current(index, name):
+    row = index.execute("SELECT size, mtime FROM sources WHERE name = ?", (name,)).fetchone()
+    if row is None or not os.path.isfile(name):
+        return False
+    st = os.stat(name)
+    return row[0] == st.st_size and row[1] == st.st_mtime_ns
+
+# This function records the size and modification time of an imported CSV file
+def index_source_imported(index, name):
+    st = os.stat(name)
+    index.execute("INSERT OR REPLACE INTO sources (name, size, mtime) VALUES (?, ?, ?)", (name, st.st_size, st.st_mtime_ns))
+
+# This function imports the local checksum files into the index if any of them have changed
+def index_local_checksums(index):
+    names = ["Local_Checksums/" + file_name for file_name in local_list_file_names]
+    if all(index_source_current(index, name) for name in names):
+        return
+    print("Importing local checksum files into the index")
+    with index:
+        index.execute("DELETE FROM local_checksums")
+        index.executemany("INSERT INTO local_checksums (path, checksum) VALUES (?, ?)", read_local_checksum_files().items())
+        for name in names:
+            index_source_imported(index, name)
+
+# This function saves the folder structure of one top level directory to the index
+# Only the directories that changed since the last save are written, so saving after an incremental scan costs as much as
+#   the directories that were listed again instead of the whole top level directory
+def index_folder_structure(index, indir, folder_structure):
+    saved = dict()
+    for row in index.execute("SELECT path, position, error, super_dir, total_files, total_tifs, mtime, entries FROM directories WHERE store = ?", (indir,)):
+        saved[row[0]] = row[1:]
+    saved_files = dict()
+    for filepath, directory, size in index.execute(
+            "SELECT f.path, f.directory, f.size FROM files f JOIN directories d ON d.path = f.directory WHERE d.store = ? ORDER BY f.directory, f.position", (indir,)):
+        saved_files.setdefault(directory, []).append((filepath, size))
+    
+    with index:
+        for directory in saved:
+            if directory not in folder_structure:
+                index.execute("DELETE FROM files WHERE directory = ?", (directory,))
+                index.execute("DELETE FROM directories WHERE path = ?", (directory,))
+        position = 0
+        for directory in folder_structure:
+            entry = folder_structure[directory]
+            row = (position, entry['error'], entry['super_dir'], entry['total_files'], entry['total_tifs'], entry.get('mtime'), entry.get('entries'))
+            if saved.get(directory) != row:
+                index.execute("INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", (indir, directory) + row)
+            sizes = entry.get('sizes', [None]*len(entry['tifs']))
+            files = [(filepath, sizes[i]) for i, filepath in enumerate(entry['tifs'])]
+            if saved_files.get(directory, []) != files:
+                index.execute("DELETE FROM files WHERE directory = ?", (directory,))
+                index.executemany("INSERT INTO files (path, directory, position, size) VALUES (?, ?, ?, ?)",
+                                  [(filepath, directory, i, size) for i, (filepath, size) in enumerate(files)])
+            position += 1
+        name = "Results/" + indir + "/folder_structure.csv"
+        if os.path.isfile(name):
+            index_source_imported(index, name)
+
+# This function reads the folder structure of one top level directory from the index
+# It returns a dictionary in the same format as read_folder_structure above
+def load_folder_structure_from_index(index, indir):
+    folder_structure = dict()
+    for directory, error, super_dir, total_files, total_tifs, mtime, entries in index.execute(
+            "SELECT path, error, super_dir, total_files, total_tifs, mtime, entries FROM directories WHERE store = ? ORDER BY position", (indir,)):
+        folder_structure[directory] = {'error': error, 'super_dir': super_dir, 'total_files': total_files, 'total_tifs': total_tifs,
+                                       'mtime': mtime, 'entries': entries, 'tifs': [], 'sizes': []}
+    for filepath, directory, size in index.execute(
+            "SELECT f.path, f.directory, f.size FROM files f JOIN directories d ON d.path = f.directory WHERE d.store = ? ORDER BY f.directory, f.position", (indir,)):
+        folder_structure[directory]['tifs'].append(filepath)
+        folder_structure[directory]['sizes'].append(size)
+    return folder_structure
+
+# This function lists a single directory for scan_directory below
+# It returns a tuple (dirs, files, walk_dirs, dir_mtimes, file_sizes) or None if the directory could not be read
+#   walk_dirs are the sub-directories that should be descended into (symbolic links are not followed, as with os.walk)
+#   dir_mtimes has the modification time of each sub-directory in walk_dirs, taken from the listing where the share provides it
+#   file_sizes has the size of each tif, also taken from the listing
+def list_directory(path):
+    dirs = []
+    files = []
+    walk_dirs = []
+    dir_mtimes = dict()
+    file_sizes = dict()
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    dirs.append(entry.name)
+                    try:
+                        if not entry.is_symlink():
+                            walk_dirs.append(entry.name)
+                            dir_mtimes[entry.name] = entry.stat().st_mtime_ns
+                    except OSError:
+                        pass
+                else:
+                    files.append(entry.name)
+                    if entry.name[-4:] == ".tif" or entry.name[-4:] == ".TIF":
+                        try:
+                            file_sizes[entry.name] = entry.stat().st_size
+                        except OSError:
+                            pass
+    except OSError:
+        return None
+    return dirs, files, walk_dirs, dir_mtimes, file_sizes
+
+# This function reads a single directory for walk_directory_tree below
+# "mtime" is the modification time of the directory if it is already known, otherwise it is read here
+# "cached" is the (mtime, entries, total_files, children) tuple saved by a previous scan or None
+#   If the modification time is unchanged and the cached entry count is consistent, the directory is not listed again
+# It returns a tuple (dirs, files, walk_dirs, dir_mtimes, file_sizes, mtime) or None if the directory could not be read
+#   files is None if the directory was taken from the cache
+def scan_directory(path, mtime=None, cached=None):
+    if mtime is None:
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+    
+    if cached is not None:
+        cached_mtime, cached_entries, cached_files, cached_children = cached
+        if cached_mtime == mtime and cached_entries == cached_files + len(cached_children):
+            return cached_children, None, cached_children, dict(), dict(), mtime
+    
+    listing = list_directory(path)
+    if listing is None:
+        return None
+    return listing + (mtime,)
+
+# This function is a parallel replacement for os.walk(top, topdown=False)
+# Directory listings are fetched by a pool of "workers" threads, each sub-directory is submitted as soon as its parent is listed
+#   so many network round-trips are in flight at once
+# "cached" is a dictionary of (mtime, entries, total_files, children) tuples keyed by full directory path, see scan_directory above
+# Once every directory is read the results are yielded bottom-up in the same order as os.walk as (root, dirs, files, mtime, file_sizes) tuples
+def walk_directory_tree(top, workers=8, cached=None):
+    if cached is None:
+        cached = dict()
+    listings = dict()
+    
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(scan_directory, top, None, cached.get(top)): top}
+        while pending:
+            done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path = pending.pop(future)
+                listing = future.result()
+                if listing is None:
+                    continue
+                listings[path] = listing
+                for directory in listing[2]:
+                    dirpath = path + "/" + directory
+                    pending[executor.submit(scan_directory, dirpath, listing[3].get(directory), cached.get(dirpath))] = dirpath
+    
+    stack = [(top, False)]
+    while stack:
+        path, expanded = stack.pop()
+        if path not in listings:
+            continue
+        dirs, files, walk_dirs, dir_mtimes, file_sizes, mtime = listings[path]
+        if expanded:
+            yield path, dirs, files, mtime, file_sizes
+        else:
+            stack.append((path, True))
+            for directory in reversed(walk_dirs):
+                stack.append((path + "/" + directory, False))
+
+# This function adds one directory to a folder structure dictionary, see get_folder_structures below
+# Its sub-directories must already have been added
+# If "files" is None the directory was not listed again and its files are taken from the "cached" entry
+# "file_sizes" is a dictionary with the sizes of the tifs in "files" or None if they are not known
+def add_directory(folder_structure, root, dirs, files, mtime=None, cached=None, verbose=False, file_sizes=None):
+    
+    if verbose: print("".join(i for i in root if ord(i)<128))
+    
+    folder_structure[root] = dict()
+    folder_structure[root]['error'] = 0
+    folder_structure[root]['super_dir'] = 0
+    folder_structure[root]['total_files'] = 0
+    folder_structure[root]['total_tifs'] = 0
+    folder_structure[root]['tifs'] = []
+    
+    # Names are saved without non ascii characters, so directories with such names can't be matched against the cache
+    if "".join(i for i in root if ord(i)<128) != root or any("".join(i for i in directory if ord(i)<128) != directory for directory in dirs):
+        mtime = None
+    folder_structure[root]['mtime'] = mtime
+    folder_structure[root]['entries'] = cached['entries'] if files is None else len(dirs) + len(files)
+        
+    if root[0:25] != "CDI_STORE_10/Photo_Shoots" :
+        
+        for directory in dirs:
+            dirpath = root + "/" + directory
+            if dirpath in folder_structure:
+                if folder_structure[dirpath]['total_tifs'] > 0 :
+                    folder_structure[root]['super_dir'] = 1
+                folder_structure[root]['error'] = folder_structure[root]['error'] or folder_structure[dirpath]['error']
+
+            else:
+                print("Error: Sub-directory not already scanned")
+                print(dirpath)
+                folder_structure[root]['error'] = 1
+        
+        if files is None:
+            folder_structure[root]['total_files'] = cached['total_files']
+            folder_structure[root]['total_tifs'] = cached['total_tifs']
+            folder_structure[root]['tifs'] = cached['tifs']
+            if 'sizes' in cached:
+                folder_structure[root]['sizes'] = cached['sizes']
+        else:
+            if file_sizes is not None:
+                folder_structure[root]['sizes'] = []
+            for file in files:
+                folder_structure[root]['total_files'] += 1
+                filepath = check_filename(root + "/" + file, False)
+                if filepath is not None:
+                    folder_structure[root]['total_tifs'] += 1
+                    folder_structure[root]['tifs'].append(filepath)
+                    if file_sizes is not None:
+                        folder_structure[root]['sizes'].append(file_sizes.get(file))
+        
+        if verbose: print("Dir contains %s files %s tifs" % (folder_structure[root]['total_files'], folder_structure[root]['total_tifs']))   
+
 # This function reads the file system and generates a dictionary to speed up future operations
 # The "keep" flag determines whether the dictionary is re-generated or read from the previous version saved in folder_structure.csv
 # It returns a dictionary: folder_structures
@@ -142,212 +940,817 @@ def get_local_checksums(folder_structures):
 #   'total_files' - The number of files in the directory not counting files in sub-directories
 #   'total_tifs' - The number of tifs in the directory not counting tifs in sub-directories
 #   'tifs' - A list of all the tifs in the directory
+#   'sizes' - A list of the size of each tif in 'tifs' (None if unknown). Only present when the sizes were read by walk_directory_tree
+#   'mtime' - The modification time of the directory in nanoseconds, or None if it is not known
+#   'entries' - The number of files and directories in the directory
 # For each top level directory the dictionary is saved to a folder_structure.csv file
-def get_folder_structures(verbose=False, keep=True):
+# If "workers" is greater than 0 the file system is read with walk_directory_tree using that many threads instead of os.walk
+# If "incremental" is set and folder_structure.csv exists, only directories whose modification time changed are listed again
+#   and the rest are taken from folder_structure.csv. The 'error' and 'super_dir' roll-ups are always recomputed
+# If an "index" connection is given (see open_index above) the folder structures are also read from and saved to the index
+def get_folder_structures(verbose=False, keep=True, workers=0, incremental=False, index=None):
     print("\nGetting folder structure")
    
     folder_structures = dict()
     
     for indir in os.listdir('Results'):
-        print("\nWorking on " + indir)    
+        folder_structures[indir] = get_folder_structure(indir, verbose, keep, workers, incremental, index)
+            
+    return folder_structures
+
+# This function gets the folder structure of one top level directory for get_folder_structures above, which describes the arguments
+def get_folder_structure(indir, verbose=False, keep=True, workers=0, incremental=False, index=None):
+    print("\nWorking on " + indir)    
+
+    folder_structure = dict()
     
-        folder_structures[indir] = dict()
+    exists = os.path.isfile("Results/" + indir + "/folder_structure.csv")
 
-        if os.path.isfile("Results/" + indir + "/folder_structure.csv") and keep:
-            print("folder_structure.csv exists: reading")
-            
-            line_count = 0
-            with open("Results/" + indir + "/folder_structure.csv") as csv_file:
-                csv_reader = csv.reader(csv_file, delimiter=',')
-                for row in csv_reader:
-                    if line_count < 1: 
-                        pass
-                    else:
-                        directory = row[0]
-                        
-                        folder_structures[indir][directory] = dict()
-                        folder_structures[indir][directory]['error'] = int(row[1])
-                        folder_structures[indir][directory]['super_dir'] = int(row[2])
-                        folder_structures[indir][directory]['total_files'] = int(row[3])
-                        folder_structures[indir][directory]['total_tifs'] = int(row[4])
-                        folder_structures[indir][directory]['tifs'] = row[5:]
-                        
-                    line_count += 1
+    if exists and keep and not incremental:
+        print("folder_structure.csv exists: reading")
+        folder_structure = read_folder_structure(indir, index)
+        
+    else:
+        cached_structure = dict()
+        cached = dict()
+        if exists and incremental:
+            print("folder_structure.csv exists: analyzing changed directories")
+            cached_structure = read_folder_structure(indir, index)
             
+            children = dict()
+            for directory in cached_structure:
+                children[directory] = []
+            for directory in cached_structure:
+                parent = directory.rsplit("/", 1)[0]
+                if parent != directory and parent in children:
+                    children[parent].append(directory[len(parent)+1:])
+            for directory in cached_structure:
+                entry = cached_structure[directory]
+                if entry['mtime'] is not None and entry['entries'] is not None:
+                    total_files = entry['total_files']
+                    # Files are not counted in these directories, so the entry count can't be checked
+                    if directory[0:25] == "CDI_STORE_10/Photo_Shoots":
+                        total_files = entry['entries'] - len(children[directory])
+                    cached[share_root + directory] = (entry['mtime'], entry['entries'], total_files, children[directory])
         else:
             print("folder_structure.csv does not exist: analyzing directories")
-                        
-            for root, dirs, files in os.walk('//files.brown.edu/DFS/Library_DPS/' + indir, topdown=False):
-                        
-                root = root[34:]
-                root = root.replace("\\", "/")
-                            
-                if verbose: print("".join(i for i in root if ord(i)<128))
-                
-                folder_structures[indir][root] = dict()
-                folder_structures[indir][root]['error'] = 0
-                folder_structures[indir][root]['super_dir'] = 0
-                folder_structures[indir][root]['total_files'] = 0
-                folder_structures[indir][root]['total_tifs'] = 0
-                folder_structures[indir][root]['tifs'] = []
-                    
-                if root[0:25] != "CDI_STORE_10/Photo_Shoots" :
+        
+        if workers > 0 or incremental:
+            walk = walk_directory_tree(share_root + indir, max(workers, 1), cached)
+        else:
+            walk = ((root, dirs, files, None, None) for root, dirs, files in os.walk(share_root + indir, topdown=False))
+        
+        listed = 0
+        for root, dirs, files, mtime, file_sizes in walk:
                     
-                    for directory in dirs:
-                        dirpath = root + "/" + directory
-                        if dirpath in folder_structures[indir]:
-                            if folder_structures[indir][dirpath]['total_tifs'] > 0 :
-                                folder_structures[indir][root]['super_dir'] = 1
-                            folder_structures[indir][root]['error'] = folder_structures[indir][root]['error'] or folder_structures[indir][dirpath]['error']
+            root = root[len(share_root):]
+            root = root.replace("\\", "/")
             
-                        else:
-                            print("Error: Sub-directory not already scanned")
-                            print(dirpath)
-                            folder_structures[indir][root]['error'] = 1
-                    
-                    for file in files:
-                        folder_structures[indir][root]['total_files'] += 1
-                        filepath = check_filename(root + "/" + file, False)
-                        if filepath is not None:
-                            folder_structures[indir][root]['total_tifs'] += 1
-                            folder_structures[indir][root]['tifs'].append(filepath)
-                    
-                    if verbose: print("Dir contains %s files %s tifs" % (folder_structures[indir][root]['total_files'], folder_structures[indir][root]['total_tifs']))   
-                
-            print("Writing results")
-            with open("Results/" + indir + "/folder_structure.csv", 'w', newline='') as csvfile:
-                writer = csv.writer(csvfile, delimiter=',')
-                writer.writerow(["Directory", "Error", "Contains Directories", "Total Files", "Total Tifs", "Tifs"])      
-                for directory in folder_structures[indir]:
-                    row = ["".join(i for i in directory if ord(i)<128), folder_structures[indir][directory]['error'], folder_structures[indir][directory]['super_dir'], folder_structures[indir][directory]['total_files'], folder_structures[indir][directory]['total_tifs']] + folder_structures[indir][directory]['tifs']
-                    writer.writerow(row)        
+            if files is not None:
+                listed += 1
+            add_directory(folder_structure, root, dirs, files, mtime, cached_structure.get(root), verbose, file_sizes)
+        
+        if incremental:
+            print("Listed %s of %s directories" % (listed, len(folder_structure)))
             
-    return folder_structures
+        print("Writing results")
+        save_folder_structure(indir, folder_structure, index)
+        
+    return folder_structure
+    
+# This class is a node of a folder tree, which totals the counts of the folder structure of one top level directory, see build_folder_tree below
+# The tree doesn't replace the folder structure, it is built from it and kept next to it, so it adds one object per directory to
+#   the memory used. Each node only stores its own name and counts
+# Besides the counts of the directory itself, every node holds the totals of its whole tree, so questions like
+#   "how many tifs under this directory are in the BDR" are answered without visiting the sub-directories
+class FolderNode:
+    __slots__ = ('name', 'parent', 'children', 'total_tifs', 'total_files', 'error', 'injested', 'duplicates',
+                 'tree_dirs', 'tree_files', 'tree_tifs', 'tree_errors', 'tree_injested', 'tree_duplicates')
+    
+    def __init__(self, name, parent=None):
+        self.name = name
+        self.parent = parent
+        self.children = dict()
+        self.total_tifs = 0
+        self.total_files = 0
+        self.error = 0
+        self.injested = 0
+        self.duplicates = 0
+        self.tree_dirs = 0
+        self.tree_files = 0
+        self.tree_tifs = 0
+        self.tree_errors = 0
+        self.tree_injested = 0
+        self.tree_duplicates = 0
+    
+    # This returns the folder path of the node
+    def path(self):
+        names = []
+        node = self
+        while node is not None:
+            names.append(node.name)
+            node = node.parent
+        return "/".join(reversed(names))
+    
+    # This returns the nodes of the tree, every node before its sub-directories
+    def walk(self):
+        nodes = [self]
+        for node in nodes:
+            nodes.extend(node.children.values())
+        return nodes
+
+# This function builds a folder tree from the folder structure of one top level directory, see get_folder_structures above
+# Directory names are interned, so names repeated across directories are only stored once
+# The tree totals are computed with sum_folder_tree below, so they don't depend on the order of the folder structure. The folder
+#   structure itself still has to be built with sub-directories before their parent, see add_directory above
+# It returns the FolderNode of the top level directory
+def build_folder_tree(folder_structure):
+    root = None
+    for directory in folder_structure:
+        names = directory.split("/")
+        if root is None:
+            root = FolderNode(sys.intern(names[0]))
+        node = root
+        for name in names[1:]:
+            if name not in node.children:
+                node.children[sys.intern(name)] = FolderNode(sys.intern(name), node)
+            node = node.children[name]
+        
+        entry = folder_structure[directory]
+        node.total_files = entry['total_files']
+        node.total_tifs = len(entry['tifs'])
+        node.error = 1 if entry['error'] else 0
+    
+    if root is not None:
+        sum_folder_tree(root)
+    return root
+
+# This function computes the tree totals of every node of a folder tree from the counts of each directory
+# Sub-directories are summed before their parent, so each node is visited once
+def sum_folder_tree(root):
+    for node in reversed(root.walk()):
+        node.tree_dirs = 0
+        node.tree_files = node.total_files
+        node.tree_tifs = node.total_tifs
+        node.tree_errors = node.error
+        node.tree_injested = node.injested
+        node.tree_duplicates = node.duplicates
+        for child in node.children.values():
+            node.tree_dirs += child.tree_dirs + 1
+            node.tree_files += child.tree_files
+            node.tree_tifs += child.tree_tifs
+            node.tree_errors += child.tree_errors
+            node.tree_injested += child.tree_injested
+            node.tree_duplicates += child.tree_duplicates
+
+# This function finds the node of a directory in the folder trees, see build_folder_tree above
+# It returns None if the directory is not in the folder trees
+def find_folder_node(folder_trees, directory):
+    names = directory.replace("\\", "/").strip("/").split("/")
+    node = folder_trees.get(names[0])
+    for name in names[1:]:
+        if node is None:
+            break
+        node = node.children.get(name)
+    return node
+
+# This function gets the folder structure and local checksums of one top level directory in a worker process, see process_stores below
+# The folder structure is read as get_folder_structure does, and it and the local checksums of the top level directory are read from
+#   the index with a separate connection. Writes to the index wait for the other processes to finish theirs
+# If "compute" is set, checksums of tifs missing from the local checksum files are computed with compute_checksums above
+#   using "hash_workers" processes. The hash cache is only read, the new entries are returned for process_stores to save
+# It returns a tuple (folder_structure, local_checksums_fwd, local_checksums_bwd, found, total, hashed) for the top level directory,
+#   where hashed is a dictionary with the new hash cache entries
+def process_store(indir, keep=False, workers=8, incremental=True, compact=False, compute=False, hash_workers=1):
+    index = sqlite3.connect(index_file_name, timeout=600)
+    folder_structure = get_folder_structure(indir, False, keep, workers, incremental, index)
+    file_checksums = dict(index.execute("SELECT path, checksum FROM local_checksums WHERE path >= ? AND path < ?", (indir + "/", indir + "0")))
+    index.close()
+    
+    hashed = dict()
+    if compute:
+        missing = []
+        for directory in folder_structure:
+            for filepath in folder_structure[directory]['tifs']:
+                if filepath not in file_checksums:
+                    missing.append(filepath)
+        hash_cache = read_hash_cache()
+        computed = compute_checksums(missing, hash_workers, hash_cache)
+        file_checksums.update(computed)
+        hashed = {filepath: hash_cache[filepath] for filepath in computed}
+    
+    local_checksums_fwd = dict()
+    local_checksums_bwd = dict()
+    found, total = match_local_checksums(folder_structure, file_checksums, local_checksums_fwd, local_checksums_bwd, compact)
+    return folder_structure, local_checksums_fwd, local_checksums_bwd, found, total, hashed
+
+# This function does the work of get_folder_structures and get_local_checksums above with each top level directory in its own process
+# At most "workers" top level directories are processed at once, each walking its file system with "scan_workers" threads
+#   Top level directories with the largest folder_structure.csv files are started first, so a large directory doesn't start last
+# The results are merged in the order of the results directory, so the dictionaries and the files written from them are the
+#   same as when the top level directories are processed one after another
+# The local checksum files are imported into the "index" first (a new connection is opened if none is given)
+# If "compute" is set, checksums of tifs missing from the local checksum files are computed as get_local_checksums does, the hashing
+#   processes are split between the top level directories and the hash cache is saved once at the end
+# It returns a tuple (folder_structures, local_checksums_fwd, local_checksums_bwd), see get_folder_structures and get_local_checksums
+def process_stores(workers=4, keep=False, scan_workers=8, incremental=True, compact=False, index=None, compute=False):
+    print("\nGetting folder structure and local checksums with %s processes" % workers)
+    
+    if index is None:
+        index = open_index()
+    index_local_checksums(index)
+    
+    indirs = os.listdir('Results')
+    sizes = dict()
+    for indir in indirs:
+        name = "Results/" + indir + "/folder_structure.csv"
+        sizes[indir] = os.path.getsize(name) if os.path.isfile(name) else 0
+    
+    folder_structures = dict()
+    local_checksums_fwd = dict()
+    local_checksums_bwd = dict()
+    hashed = dict()
+    found = 0
+    total = 0
+    hash_workers = max(1, workers // max(1, min(workers, len(indirs))))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = dict()
+        for indir in sorted(indirs, key=lambda i: sizes[i], reverse=True):
+            futures[indir] = executor.submit(process_store, indir, keep, scan_workers, incremental, compact, compute, hash_workers)
+        
+        for indir in indirs:
+            folder_structure, store_fwd, store_bwd, store_found, store_total, store_hashed = futures[indir].result()
+            folder_structures[indir] = folder_structure
+            merge_local_checksums(local_checksums_fwd, local_checksums_bwd, store_fwd, store_bwd, compact)
+            hashed.update(store_hashed)
+            found += store_found
+            total += store_total
+            print("Finished " + indir)
+    
+    if len(hashed) > 0:
+        hash_cache = read_hash_cache()
+        hash_cache.update(hashed)
+        save_hash_cache(hash_cache)
+    
+    print("Found %s of %s" % (found, total))
+    
+    return folder_structures, local_checksums_fwd, local_checksums_bwd
+
+# This function builds a columnar table of the tifs in the folder structure of one top level directory
+# Files are stored in the order of the folder structure, so the files of each directory are a contiguous range of rows
+# It returns a dictionary: file_table
+#   'directories' - A list of the directories, the position of a directory is its directory id
+#   'starts' - An array with the first row of each directory, plus the total number of rows at the end
+#   'paths' - A list of the file paths of each row
+#   'dir_ids' - An array with the directory id of each row
+#   'checksums' - A list of the distinct checksums, the position of a checksum is its checksum id
+#                 Checksum id 0 is None, used for files without a checksum or missing from the local checksums
+#   'checksum_ids' - An array with the checksum id of each row
+#   'missing' - A bytearray that is 1 for each row missing from the local checksums
+def build_file_table(folder_structure, local_checksums):
+    directories = []
+    starts = array.array('L')
+    paths = []
+    dir_ids = array.array('L')
+    checksums = [None]
+    checksum_ids = array.array('L')
+    missing = bytearray()
+    
+    checksum_id = {None: 0}
+    for directory in folder_structure:
+        dir_id = len(directories)
+        directories.append(directory)
+        starts.append(len(paths))
+        for filepath in folder_structure[directory]['tifs']:
+            paths.append(filepath)
+            dir_ids.append(dir_id)
+            if filepath in local_checksums:
+                checksum = local_checksums[filepath]
+                missing.append(0)
+            else:
+                print("Error: File not found")
+                print(filepath)
+                checksum = None
+                missing.append(1)
+            if checksum not in checksum_id:
+                checksum_id[checksum] = len(checksums)
+                checksums.append(checksum)
+            checksum_ids.append(checksum_id[checksum])
+    starts.append(len(paths))
+    
+    return {'directories': directories, 'starts': starts, 'paths': paths, 'dir_ids': dir_ids,
+            'checksums': checksums, 'checksum_ids': checksum_ids, 'missing': missing}
+
+# This function sets a flag for every checksum in a file table and counts the flagged files of each directory
+# "flags" is a bytearray with a 0 or 1 for each checksum id of the file table
+# The flags are spread to the rows and counted per directory with map, compress and Counter,
+#   so the work is done in a few passes over the columns instead of a Python loop over the files
+# It returns a tuple (file_flags, counts)
+#   file_flags is a bytes object with the flag of each row and counts is a Counter of flagged rows keyed by directory id
+def count_flagged_files(file_table, flags):
+    file_flags = bytes(map(flags.__getitem__, file_table['checksum_ids']))
+    counts = Counter(compress(file_table['dir_ids'], file_flags))
+    return file_flags, counts
+
+# This function marks directories with files missing from the local checksums as errors in the folder structure
+def mark_missing_files(folder_structure, file_table):
+    for dir_id in Counter(compress(file_table['dir_ids'], file_table['missing'])):
+        folder_structure[file_table['directories'][dir_id]]['error'] = 1
+
+# The number of ranked directories rank_directories below keeps in memory before it sorts them and spills them to a temporary file
+rank_chunk_size = 100000
+
+# This function opens a csv file in the results directory for writing
+# If "gzipped" is set the file is gzip compressed and ".gz" is added to its name
+# The file written by the other setting is removed, so an out of date copy is not left behind
+def open_report(file_name, gzipped=False):
+    stale = file_name if gzipped else file_name + '.gz'
+    if os.path.exists(stale):
+        os.remove(stale)
+    if gzipped:
+        return gzip.open(file_name + '.gz', 'wt', newline='')
+    return open(file_name, 'w', newline='')
+
+# This function sorts a chunk of ranked directories and writes it to a temporary file for rank_directories below
+# It returns the temporary file, positioned at its start
+def spill_ranked(chunk):
+    chunk.sort(reverse=True)
+    spill = tempfile.TemporaryFile()
+    for row in chunk:
+        pickle.dump(row, spill, pickle.HIGHEST_PROTOCOL)
+    spill.seek(0)
+    return spill
+
+# This function reads back the rows of a file written by spill_ranked above one at a time, and closes it at the end
+def read_spilled(spill):
+    with spill:
+        while True:
+            try:
+                yield pickle.load(spill)
+            except EOFError:
+                return
+
+# This function ranks the directories of a file table by the share of their tifs that are flagged
+# If "top" is given only the "top" highest directories are kept, in a heap of that size. Otherwise the directories are
+#   sorted in chunks of rank_chunk_size, spilled to temporary files and merged, so only one chunk is held in memory
+# It returns an iterator of (percent, count, directory id) tuples for the directories with flagged files, highest first,
+#   which can only be read once
+def rank_directories(folder_structure, file_table, counts, top=None):
+    directories = file_table['directories']
+    rows = ((counts[dir_id] / folder_structure[directories[dir_id]]['total_tifs'], counts[dir_id], directories[dir_id], dir_id) for dir_id in counts)
+    if top is not None:
+        ranked = heapq.nlargest(top, rows)
+    else:
+        spills = []
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= rank_chunk_size:
+                spills.append(spill_ranked(chunk))
+                chunk = []
+        chunk.sort(reverse=True)
+        ranked = heapq.merge(chunk, *[read_spilled(spill) for spill in spills], reverse=True)
+    return ((percent, count, dir_id) for percent, count, directory, dir_id in ranked)
+
+# This function returns the row of a directory in a directory summary csv file
+def directory_summary_row(folder_structure, directory, count, percent):
+    return [directory, "Yes" if folder_structure[directory]['error'] else " ", "Yes" if folder_structure[directory]['super_dir'] else " ", folder_structure[directory]['total_files'], folder_structure[directory]['total_tifs'], count, "%02f%%" % (percent*100)]
+
+# This function writes the two bdr collision csv files of one top level directory, see analyze_dir_bdr_collisions below
+# bdr_found is a dictionary from lookup_bdr_checksums with the BDR numbers of the checksums in the BDR
+# Both files are written in one pass over the ranking made by rank_directories above, and each row is written as soon as it is made
+def write_injested_reports(indir, folder_structure, file_table, file_injested, ranked, bdr_found, gzipped=False):
+    paths = file_table['paths']
+    checksums = file_table['checksums']
+    checksum_ids = file_table['checksum_ids']
     
+    with open_report('Results/' + indir + '/directories_injested.csv', gzipped) as summary_file, \
+         open_report('Results/' + indir + '/directories_injested_files.csv', gzipped) as csvfile:
+        summary_writer = csv.writer(summary_file, delimiter=',')
+        summary_writer.writerow(["Directory", "Error", "Contains Directories", "Total Files", "Total Tifs", "Injested Tifs", "Percent Injested"])
+        writer = csv.writer(csvfile, delimiter=',')
+        writer.writerow(["File", "Injested", "Instances", "BDR Numbers"])    
+        
+        for percent_injested, injested, dir_id in ranked:
+            summary_writer.writerow(directory_summary_row(folder_structure, file_table['directories'][dir_id], injested, percent_injested))
+            row = [""]
+            writer.writerow(row)    
+            
+            for i in range(file_table['starts'][dir_id], file_table['starts'][dir_id+1]):
+                if checksum_ids[i] == 0:
+                    row = [paths[i], "Error"]
+                elif file_injested[i]:
+                    bdr_numbers = bdr_found[checksums[checksum_ids[i]]]
+                    row = [paths[i], "Yes", len(bdr_numbers)] + bdr_numbers
+                else:
+                    row = [paths[i], "No"]
+                writer.writerow(row)             
+
+# This function writes the two local collision csv files of one top level directory, see analyze_dir_local_collisions below
+# Like write_injested_reports above both files are written in one pass, and the matching files are written straight from
+#   local_checksums_fwd instead of being copied to a list first
+def write_duplicate_reports(indir, folder_structure, file_table, file_dups, ranked, local_checksums_fwd, gzipped=False):
+    paths = file_table['paths']
+    checksums = file_table['checksums']
+    checksum_ids = file_table['checksum_ids']
+        
+    with open_report('Results/' + indir + '/directories_with_duplicates.csv', gzipped) as summary_file, \
+         open_report('Results/' + indir + '/directories_with_duplicates_files.csv', gzipped) as csvfile:
+        summary_writer = csv.writer(summary_file, delimiter=',')
+        summary_writer.writerow(["Directory", "Error", "Contains Directories", "Total Files", "Total Tifs", "Duplicate Tifs", "Percent Duplicates"])
+        writer = csv.writer(csvfile, delimiter=',')
+        writer.writerow(["File", "Duplicate", "Matches", "Matching Files"])    
+        
+        for percent_dup, dups, dir_id in ranked:
+            summary_writer.writerow(directory_summary_row(folder_structure, file_table['directories'][dir_id], dups, percent_dup))
+            row = [""]
+            writer.writerow(row)    
+            
+            for i in range(file_table['starts'][dir_id], file_table['starts'][dir_id+1]):
+                filepath = paths[i]
+                if checksum_ids[i] == 0:
+                    row = [filepath, "Error"]
+                elif file_dups[i]:
+                    entries = checksum_entries(local_checksums_fwd, checksums[checksum_ids[i]])
+                    row = chain([filepath, "Yes", len(entries) - entries.count(filepath)], (j for j in entries if j != filepath))
+                else:
+                    row = [filepath, "No"]
+                writer.writerow(row)             
+
+# This function returns a bytearray that is 1 for each checksum of a file table found in the BDR
+def get_injested_flags(file_table, bdr_found):
+    return bytearray(map(bdr_found.__contains__, file_table['checksums']))
+
+# This function returns a bytearray that is 1 for each checksum of a file table shared by more than one local file
+def get_duplicate_flags(file_table, local_checksums_fwd):
+    flags = bytearray(len(file_table['checksums']))
+    for checksum_id, checksum in enumerate(file_table['checksums']):
+        if checksum is not None and len(checksum_entries(local_checksums_fwd, checksum)) > 1:
+            flags[checksum_id] = 1
+    return flags
+
 # This function generates two files for each top level directory that list collisions between local files and the BDR
 # directories_injested.csv lists every directory that contains injested tifs, how many files it contains, and other information
 # directories_injested_files.csv lists every tif in each directory that contains injested tifs, and other information
-def analyze_dir_bdr_collisions(folder_structures, local_checksums, bdr_checksums):    
+# If "top" is given only the "top" directories with the highest share of injested tifs are listed, and if "gzipped" is set
+#   the files are gzip compressed, see rank_directories and open_report above
+def analyze_dir_bdr_collisions(folder_structures, local_checksums, bdr_checksums, top=None, gzipped=False):    
     print("\nAnalyzing directories for bdr collisions")
     
     for indir in os.listdir('Results'):
-
-        with open('Results/' + indir + '/directories_injested.csv', 'w', newline='') as csvfile:
-            writer = csv.writer(csvfile, delimiter=',')
-            writer.writerow(["Directory", "Error", "Contains Directories", "Total Files", "Total Tifs", "Injested Tifs", "Percent Injested"])        
-            
-            dirs_injested = []
-            
-            for directory in folder_structures[indir]:
-                injested = 0
-                for filepath in folder_structures[indir][directory]['tifs']:
-                    if filepath in local_checksums:
-                        checksum = local_checksums[filepath]
-                        if checksum is not None and checksum in bdr_checksums:
-                            injested += 1
-                    else:
-                        print("Error: File not found")
-                        print(filepath)                        
-                        folder_structures[indir][directory]['error'] = True
-                if injested > 0:
-                    dirs_injested.append((injested / folder_structures[indir][directory]['total_tifs'], injested, directory))
-                    
-            dirs_injested.sort(reverse=True)
-            
-            for percent_injested, injested, directory in dirs_injested:
-                row = [directory, "Yes" if folder_structures[indir][directory]['error'] else " ", "Yes" if folder_structures[indir][directory]['super_dir'] else " ", folder_structures[indir][directory]['total_files'], folder_structures[indir][directory]['total_tifs'], injested, "%02f%%" % (percent_injested*100)]
-                writer.writerow(row)      
-    
-        with open('Results/' + indir + '/directories_injested_files.csv', 'w', newline='') as csvfile:
-            writer = csv.writer(csvfile, delimiter=',')
-            writer.writerow(["File", "Injested", "Instances", "BDR Numbers"])    
-            
-            for percent_injested, injested, directory in dirs_injested:
-                row = [""]
-                writer.writerow(row)    
-                
-                for filepath in folder_structures[indir][directory]['tifs']:
-                    if filepath in local_checksums:
-                        checksum = local_checksums[filepath]
-                        if checksum is not None:
-                            if checksum in bdr_checksums:
-                                row = [filepath, "Yes", len(bdr_checksums[checksum])] + bdr_checksums[checksum]
-                            else:
-                                row = [filepath, "No"]
-                        else:
-                            row = [filepath, "Error"]
-                    else:
-                        print("Error: File not found")
-                        print(filepath)   
-                        row = [filepath, "Error"]
-                    writer.writerow(row)             
+        
+        file_table = build_file_table(folder_structures[indir], local_checksums)
+        mark_missing_files(folder_structures[indir], file_table)
+        
+        bdr_found = lookup_bdr_checksums(bdr_checksums, file_table['checksums'][1:])
+        file_injested, counts = count_flagged_files(file_table, get_injested_flags(file_table, bdr_found))
+        ranked = rank_directories(folder_structures[indir], file_table, counts, top)
+        
+        write_injested_reports(indir, folder_structures[indir], file_table, file_injested, ranked, bdr_found, gzipped)
                     
 # This function generates two files for each top level directory that list duplicate tifs within the fily system
 # directories_with_duplicates.csv lists every directory that contains duplicate tifs, how many files it contains, and other information
 # directories_with_duplicates_files.csv lists every tif in each directory that contains duplicate tifs, and other information
-def analyze_dir_local_collisions(folder_structures, local_checksums_fwd, local_checksums_bwd):   
+# "top" and "gzipped" are used like in analyze_dir_bdr_collisions above
+def analyze_dir_local_collisions(folder_structures, local_checksums_fwd, local_checksums_bwd, top=None, gzipped=False):   
     print("\nAnalyzing directories for local collisions")
     
     for indir in os.listdir('Results'):
-
-        dirs_with_dups = []
         
-        for directory in folder_structures[indir]:
-            dups = 0
-            for filepath in folder_structures[indir][directory]['tifs']:
-                if filepath in local_checksums_bwd:
-                    checksum = local_checksums_bwd[filepath]
-                    if checksum is not None:
-                        if len(local_checksums_fwd[checksum]) > 1:
-                            dups += 1
-                else:
-                    print("Error: File not found")
-                    print(filepath)                        
-                    folder_structures[indir][directory]['error'] = True
-            if dups > 0:
-                dirs_with_dups.append((dups / folder_structures[indir][directory]['total_tifs'], dups, directory))
-                
-        dirs_with_dups.sort(reverse=True)    
+        file_table = build_file_table(folder_structures[indir], local_checksums_bwd)
+        mark_missing_files(folder_structures[indir], file_table)
         
-        with open('Results/' + indir + '/directories_with_duplicates.csv', 'w', newline='') as csvfile:
-            writer = csv.writer(csvfile, delimiter=',')
-            writer.writerow(["Directory", "Error", "Contains Directories", "Total Files", "Total Tifs", "Duplicate Tifs", "Percent Duplicates"])        
-            
-            for percent_dup, dups, directory in dirs_with_dups:
-                row = [directory, "Yes" if folder_structures[indir][directory]['error'] else " ", "Yes" if folder_structures[indir][directory]['super_dir'] else " ", folder_structures[indir][directory]['total_files'], folder_structures[indir][directory]['total_tifs'], dups, "%02f%%" % (percent_dup*100)]
-                writer.writerow(row)
-            
-        with open('Results/' + indir + '/directories_with_duplicates_files.csv', 'w', newline='') as csvfile:
-            writer = csv.writer(csvfile, delimiter=',')
-            writer.writerow(["File", "Duplicate", "Matches", "Matching Files"])    
-            
-            for percent_dup, dups, directory in dirs_with_dups:
-                row = [""]
-                writer.writerow(row)    
-                
+        file_dups, counts = count_flagged_files(file_table, get_duplicate_flags(file_table, local_checksums_fwd))
+        ranked = rank_directories(folder_structures[indir], file_table, counts, top)
+        
+        write_duplicate_reports(indir, folder_structures[indir], file_table, file_dups, ranked, local_checksums_fwd, gzipped)
+
+# This function writes all four collision csv files of one top level directory, see analyze_dir_collisions below
+# Every file is classified once, and both analyses are written from the same file table
+# It returns a tuple (missing, injested, duplicates): the list of directories that contain files missing from the local checksums,
+#   and dictionaries with the number of injested and duplicate tifs of each directory
+def analyze_store(indir, folder_structure, local_checksums_fwd, local_checksums_bwd, bdr_checksums, top=None, gzipped=False):
+    
+    file_table = build_file_table(folder_structure, local_checksums_bwd)
+    mark_missing_files(folder_structure, file_table)
+    
+    bdr_found = lookup_bdr_checksums(bdr_checksums, file_table['checksums'][1:])
+    file_injested, injested_counts = count_flagged_files(file_table, get_injested_flags(file_table, bdr_found))
+    ranked = rank_directories(folder_structure, file_table, injested_counts, top)
+    write_injested_reports(indir, folder_structure, file_table, file_injested, ranked, bdr_found, gzipped)
+    
+    file_dups, duplicate_counts = count_flagged_files(file_table, get_duplicate_flags(file_table, local_checksums_fwd))
+    ranked = rank_directories(folder_structure, file_table, duplicate_counts, top)
+    write_duplicate_reports(indir, folder_structure, file_table, file_dups, ranked, local_checksums_fwd, gzipped)
+    
+    directories = file_table['directories']
+    missing = Counter(compress(file_table['dir_ids'], file_table['missing']))
+    return ([directories[dir_id] for dir_id in missing],
+            {directories[dir_id]: count for dir_id, count in injested_counts.items()},
+            {directories[dir_id]: count for dir_id, count in duplicate_counts.items()})
+
+# This function generates the files of both analyze_dir_bdr_collisions and analyze_dir_local_collisions above in one pass
+# If "workers" is greater than 0, each top level directory is analyzed in its own process, with at most "workers" at once
+#   Each process is only sent the checksums of its own top level directory. A BDRDigestIndex is shared through its file
+# "top" and "gzipped" are used like in analyze_dir_bdr_collisions above
+# It returns a dictionary: directory_counts
+#   The keys are the top level directories and the values are (injested, duplicates) dictionaries with the number of injested
+#   and duplicate tifs of each directory, see analyze_store above. Use build_folder_trees below to total them over each tree
+def analyze_dir_collisions(folder_structures, local_checksums_fwd, local_checksums_bwd, bdr_checksums, workers=0, top=None, gzipped=False):
+    print("\nAnalyzing directories for bdr and local collisions")
+    
+    indirs = os.listdir('Results')
+    directory_counts = dict()
+    
+    if workers == 0:
+        for indir in indirs:
+            results = analyze_store(indir, folder_structures[indir], local_checksums_fwd, local_checksums_bwd, bdr_checksums, top, gzipped)
+            directory_counts[indir] = results[1:]
+        return directory_counts
+    
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for indir in indirs:
+            store_bwd = dict()
+            store_fwd = dict()
+            for directory in folder_structures[indir]:
                 for filepath in folder_structures[indir][directory]['tifs']:
                     if filepath in local_checksums_bwd:
                         checksum = local_checksums_bwd[filepath]
+                        store_bwd[filepath] = checksum
                         if checksum is not None:
-                            if len(local_checksums_fwd[checksum]) > 1:
-                                matches = []
-                                for i in local_checksums_fwd[checksum]:
-                                    if i != filepath: matches.append(i)
-                                row = [filepath, "Yes", len(matches)] + matches
-                            else:
-                                row = [filepath, "No"]
-                        else:
-                            row = [filepath, "Error"]
+                            store_fwd[checksum] = local_checksums_fwd[checksum]
+            
+            if isinstance(bdr_checksums, BDRDigestIndex):
+                store_bdr = bdr_checksums
+            else:
+                store_bdr = lookup_bdr_checksums(bdr_checksums, store_fwd)
+            
+            futures.append(executor.submit(analyze_store, indir, folder_structures[indir], store_fwd, store_bwd, store_bdr, top, gzipped))
+        
+        for indir, future in zip(indirs, futures):
+            missing, injested, duplicates = future.result()
+            for directory in missing:
+                folder_structures[indir][directory]['error'] = 1
+            directory_counts[indir] = injested, duplicates
+            print("Finished " + indir)
+    
+    return directory_counts
+
+# This function builds the folder tree of one top level directory with the number of injested and duplicate tifs of each directory
+# "injested" and "duplicates" are dictionaries with the counts of each directory, see analyze_store above
+def build_store_tree(folder_structure, injested, duplicates):
+    root = build_folder_tree(folder_structure)
+    if root is None:
+        return None
+    folder_trees = {root.name: root}
+    for directory in injested:
+        find_folder_node(folder_trees, directory).injested = injested[directory]
+    for directory in duplicates:
+        find_folder_node(folder_trees, directory).duplicates = duplicates[directory]
+    sum_folder_tree(root)
+    return root
+
+# This function builds the folder trees of all top level directories from the counts returned by analyze_dir_collisions above
+# The trees add to the memory used by the folder structures, so they are only built for --summary and the directory lookups
+#   of the serve phase
+def build_folder_trees(folder_structures, directory_counts):
+    folder_trees = dict()
+    for indir in directory_counts:
+        root = build_store_tree(folder_structures[indir], *directory_counts[indir])
+        if root is not None:
+            folder_trees[indir] = root
+    return folder_trees
+
+# This function prints how much of a directory tree is injested or duplicated, see analyze_dir_collisions above
+def print_folder_summary(folder_trees, directory):
+    node = find_folder_node(folder_trees, directory)
+    if node is None:
+        print("Directory not found: " + directory)
+        return
+    print("\n" + node.path())
+    print("Contains %s directories %s files %s tifs" % (node.tree_dirs, node.tree_files, node.tree_tifs))
+    if node.tree_tifs > 0:
+        print("Injested %s tifs (%02f%%)" % (node.tree_injested, node.tree_injested / node.tree_tifs * 100))
+        print("Duplicate %s tifs (%02f%%)" % (node.tree_duplicates, node.tree_duplicates / node.tree_tifs * 100))
+    print("%s directories with errors" % node.tree_errors)
+
+# The functions below move files with a move plan instead of moving them one at a time
+# A move plan is a list of (operation, source, destination) steps, where the operation is one of
+#   'makedirs' - create the source directory and any missing parent directories
+#   'rename' - move the source file or directory to the destination
+#   'rmdir' - remove the source directory, which must be empty
+# Every step of a plan is recorded in an append-only journal in the journal directory, so an interrupted run can be
+#   finished with resume_move_plan or undone with rollback_move_plan
+# A step is recorded as 'started' before it runs and as 'done' or 'failed' after, so a step that was interrupted after it took
+#   effect is not lost: see move_step_done below
+# Before a 'makedirs' step runs, each directory it is about to create is recorded as 'creating', so a rollback only removes
+#   directories the plan created and leaves directories that were already there
+
+# This function writes a move plan to <name>_plan.csv in the journal directory so it can be checked before it is run
+def write_move_plan(plan, name):
+    if not os.path.isdir(journal_dir_name):
+        os.makedirs(journal_dir_name)
+    counts = Counter(step[0] for step in plan)
+    with open(journal_dir_name + '/' + name + '_plan.csv', 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile, delimiter=',')
+        writer.writerow(["Step", "Operation", "Source", "Destination"])
+        for step_id, (operation, source, destination) in enumerate(plan):
+            writer.writerow([step_id, operation, source, destination])
+    print("Planned %s directories to create, %s moves and %s directories to remove: see %s" % (counts['makedirs'], counts['rename'], counts['rmdir'], journal_dir_name + '/' + name + '_plan.csv'))
+
+# This function runs a single step of a move plan
+# It returns an empty string if the step succeeded and the error message otherwise
+def run_move_step(operation, source, destination):
+    try:
+        if operation == 'makedirs':
+            os.makedirs(source, exist_ok=True)
+        elif operation == 'rename':
+            os.rename(source, destination)
+        elif operation == 'rmdir':
+            os.rmdir(source)
+        else:
+            return "Unknown operation " + operation
+    except OSError as error:
+        return str(error)
+    return ""
+
+# This function checks whether a step of a move plan has already taken effect, for a step that was started but not recorded as done
+# A rename is done if its source is gone and its destination exists, a created directory exists and a removed directory is gone
+def move_step_done(operation, source, destination):
+    if operation == 'makedirs':
+        return os.path.isdir(source)
+    if operation == 'rename':
+        return not os.path.lexists(source) and os.path.lexists(destination)
+    if operation == 'rmdir':
+        return not os.path.lexists(source)
+    return False
+
+# This function returns the directories a 'makedirs' step would create, the directory itself and its missing parents
+def missing_directories(path):
+    missing = []
+    while path != os.path.dirname(path) and not os.path.lexists(path):
+        missing.append(path)
+        path = os.path.dirname(path)
+    return missing
+
+# This function reads a journal written by execute_move_plan below
+# It returns a tuple (plan, status, created) where status is a dictionary with the latest status of each step and created is
+#   the set of directories recorded as 'creating'
+def read_journal(journal_path):
+    plan = []
+    status = dict()
+    created = set()
+    with open(journal_path, newline='') as csv_file:
+        csv_reader = csv.reader(csv_file, delimiter=',')
+        line_count = 0
+        for row in csv_reader:
+            if line_count > 0 and len(row) >= 5:
+                step_id = int(row[0])
+                if row[1] == 'planned':
+                    plan.append((row[2], row[3], row[4]))
+                if row[1] == 'creating':
+                    created.add(row[3])
+                else:
+                    status[step_id] = row[1]
+            line_count += 1
+    return plan, status, created
+
+# This function runs a move plan
+# Steps run in three batches: first every directory is created, then all files are moved by a pool of "workers" threads,
+#   then directories are removed in the order of the plan
+# A new journal named after "name" is started in the journal directory, unless "journal_path" is given, in which case the steps
+#   not yet done in that journal are run and recorded in it. Steps that were started or failed but have already taken effect
+#   are recorded as done without running them again
+# It returns a tuple (journal path, number of failed steps)
+def execute_move_plan(plan, name, workers=8, journal_path=None):
+    if journal_path is None:
+        if not os.path.isdir(journal_dir_name):
+            os.makedirs(journal_dir_name)
+        journal_path = journal_dir_name + '/' + name + '_journal_' + time.strftime('%Y%m%d_%H%M%S') + '.csv'
+        with open(journal_path, 'w', newline='') as journal_file:
+            writer = csv.writer(journal_file, delimiter=',')
+            writer.writerow(["Step", "Status", "Operation", "Source", "Destination", "Message"])
+            for step_id, (operation, source, destination) in enumerate(plan):
+                writer.writerow([step_id, 'planned', operation, source, destination, ""])
+        status = dict()
+    else:
+        plan, status = read_journal(journal_path)[:2]
+    print("Journal: " + journal_path)
+    
+    failed = 0
+    done = 0
+    lock = threading.Lock()
+    with open(journal_path, 'a', newline='') as journal_file:
+        writer = csv.writer(journal_file, delimiter=',')
+        
+        def run_step(step_id):
+            operation, source, destination = plan[step_id]
+            if status.get(step_id) in ('started', 'failed') and move_step_done(operation, source, destination):
+                return ""
+            with lock:
+                if operation == 'makedirs':
+                    for directory in missing_directories(source):
+                        writer.writerow([step_id, 'creating', operation, directory, "", ""])
+                writer.writerow([step_id, 'started', operation, source, destination, ""])
+                journal_file.flush()
+            return run_move_step(operation, source, destination)
+        
+        for batch in ('makedirs', 'rename', 'rmdir'):
+            steps = [step_id for step_id, step in enumerate(plan) if step[0] == batch and status.get(step_id) != 'done']
+            if batch == 'rmdir':
+                results = ((step_id, run_step(step_id)) for step_id in steps)
+                executor = None
+            else:
+                executor = ThreadPoolExecutor(max_workers=workers)
+                results = zip(steps, executor.map(run_step, steps))
+            
+            for step_id, message in results:
+                operation, source, destination = plan[step_id]
+                with lock:
+                    if message == "":
+                        writer.writerow([step_id, 'done', operation, source, destination, ""])
+                        done += 1
                     else:
-                        print("Error: File not found")
-                        print(filepath)  
-                        row = [filepath, "Error"]
-                    writer.writerow(row)             
+                        print("Error: " + message)
+                        writer.writerow([step_id, 'failed', operation, source, destination, message])
+                        failed += 1
+                    journal_file.flush()
+            
+            if executor is not None:
+                executor.shutdown()
+    
+    print("%s steps done, %s steps failed" % (done, failed))
+    return journal_path, failed
+
+# This function finishes a move plan that was interrupted, running every step of its journal that is not done
+# It returns the number of failed steps
+def resume_move_plan(journal_path, workers=8):
+    print("\nResuming " + journal_path)
+    return execute_move_plan(None, None, workers, journal_path)[1]
+
+# This function undoes the steps of a move plan that are recorded as done in its journal, and the steps that were started or
+#   failed but took effect anyway, see move_step_done above
+# Removed directories are created again, moved files are moved back, and the directories recorded as 'creating' are removed if
+#   they are empty. Directories that existed before the plan ran are left alone
+# Each undone step is recorded in the journal as 'undone'
+def rollback_move_plan(journal_path, workers=8):
+    print("\nRolling back " + journal_path)
+    plan, status, created = read_journal(journal_path)
+    steps = [step_id for step_id in range(len(plan)) if status.get(step_id) == 'done' or
+             (status.get(step_id) in ('started', 'failed') and move_step_done(*plan[step_id]))]
+    
+    undone = 0
+    with open(journal_path, 'a', newline='') as journal_file:
+        writer = csv.writer(journal_file, delimiter=',')
+        
+        def record(step_id, message):
+            operation, source, destination = plan[step_id]
+            if message == "":
+                writer.writerow([step_id, 'undone', operation, source, destination, ""])
+            else:
+                print("Error: " + message)
+                writer.writerow([step_id, 'rollback failed', operation, source, destination, message])
+            journal_file.flush()
+            return message == ""
+        
+        for step_id in reversed(steps):
+            if plan[step_id][0] == 'rmdir':
+                undone += record(step_id, run_move_step('makedirs', plan[step_id][1], ""))
+        
+        renames = [step_id for step_id in reversed(steps) if plan[step_id][0] == 'rename']
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for step_id, message in zip(renames, executor.map(lambda i: run_move_step('rename', plan[i][2], plan[i][1]), renames)):
+                undone += record(step_id, message)
+        
+        # Sub-directories are removed before their parents
+        for directory in sorted(created, key=len, reverse=True):
+            if os.path.isdir(directory):
+                run_move_step('rmdir', directory, "")
+        for step_id in (i for i in steps if plan[i][0] == 'makedirs'):
+            if plan[step_id][1] in created and os.path.isdir(plan[step_id][1]):
+                undone += record(step_id, "Directory is not empty: " + plan[step_id][1])
+            else:
+                undone += record(step_id, "")
+    
+    print("Undid %s of %s steps" % (undone, len(steps)))
+
+# This function writes a move plan and runs it unless "dry_run" is set, see execute_move_plan above
+# It returns the number of failed steps
+def run_move_plan(plan, name, dry_run=False, workers=8):
+    write_move_plan(plan, name)
+    if dry_run or len(plan) == 0:
+        return 0
+    return execute_move_plan(plan, name, workers)[1]
 
 # This function removes tif "artifacts" from the file system
 # These files start with "._" and have a small file size (less than 1 MB)
-def move_tiff_artifacts(indir=""): 
-    for root, dirs, files in os.walk('//files.brown.edu/DFS/Library_DPS/' + indir, topdown=False):
+# "indir" is the directory to look in, relative to the share
+# If "dry_run" is set the moves are only written to artifacts_<indir>_plan.csv in the journal directory
+def move_tiff_artifacts(indir="", dry_run=False, workers=8): 
+    plan = []
+    new_roots = set()
+    for root, dirs, files in os.walk(share_root + indir, topdown=False):
         for filename in files:
             if filename[-4:] == ".tif" or filename[-4:] == ".TIF":
                 if filename[0:2] == '._' :
@@ -356,25 +1759,39 @@ def move_tiff_artifacts(indir=""):
                     
                     if os.path.getsize(full_filepath) < 1024*1024 :
                         
-                        new_root = '//files.brown.edu/DFS/Library_DPS/MOVED' + root[33:]
+                        new_root = share_root + 'MOVED' + root[len(share_root)-1:]
                         
-                        if not os.path.isdir(new_root):
-                            os.makedirs(new_root)
+                        if new_root not in new_roots:
+                            new_roots.add(new_root)
+                            plan.append(('makedirs', new_root, ""))
                     
-                        os.rename(full_filepath, new_root + "/" + filename)
+                        plan.append(('rename', full_filepath, new_root + "/" + filename))
                     
                     else:
                         print("FILE TOO BIG")
                         print(full_filepath)
+    
+    run_move_plan(plan, 'artifacts_' + indir.replace("/", "_") if indir != "" else 'artifacts', dry_run, workers)
                         
+# This function returns the steps that move an empty directory, see move_empty_dirs below
+def plan_empty_dir_move(root, files):
+    new_root = share_root + 'MOVED' + root[len(share_root)-1:]
+    plan = [('makedirs', new_root, "")]
+    for filename in files :
+        plan.append(('rename', root + "/" + filename, new_root + "/" + filename))
+    plan.append(('rmdir', root, ""))
+    return plan
+
 # This function removes empty directories from the file system   
 # "._.DS_Store" and ".DS_Store" files are ignored
-def move_empty_dirs():
+# If "dry_run" is set the moves are only written to empty_dirs_plan.csv in the journal directory
+def move_empty_dirs(dry_run=False, workers=8):
+    plan = []
     for indir in os.listdir('Results'):
         print("\nWorking on " + indir) 
         moved = 0
         
-        for root, dirs, files in os.walk('//files.brown.edu/DFS/Library_DPS/' + indir, topdown=False):
+        for root, dirs, files in os.walk(share_root + indir, topdown=False):
             
             if len(dirs) == 0 :
                 empty = True
@@ -385,98 +1802,94 @@ def move_empty_dirs():
                         break
                 
                 if empty :
-                    new_root = '//files.brown.edu/DFS/Library_DPS/MOVED' + root[33:]
-                    if not os.path.isdir(new_root):
-                        os.makedirs(new_root)
-                    
-                    for filename in files :
-                        os.rename(root + "/" + filename, new_root + "/" + filename)
-                    
-                    os.rmdir(root)                
+                    plan.extend(plan_empty_dir_move(root, files))
                     moved += 1
                     
-        print("Moved %s empty directories" % moved)
-            
-# This is a helper function for move_duplicate_directories below
-def move_duplicate_directories_helper(local_checksums, folder_structures, folder_dir_hashes):
+        print("Found %s empty directories" % moved)
+    
+    run_move_plan(plan, 'empty_dirs', dry_run, workers)
+
+# This function does the work of get_folder_structures, move_tiff_artifacts and move_empty_dirs above with a single walk of the file system
+# Each directory is listed once by walk_directory_tree with "workers" threads, and the sizes of tif artifacts are taken from the listing
+# Tif artifacts are moved as in move_tiff_artifacts, and empty directories as in move_empty_dirs, where a directory that only contains
+#   artifacts and "._.DS_Store" and ".DS_Store" files also counts as empty
+# Every move goes into one plan, written to maintenance_plan.csv in the journal directory and run unless "dry_run" is set
+# Unless "dry_run" is set, the folder structures are built as they are after the moves, and are saved to folder_structure.csv and the index like get_folder_structures does
+#   Directories changed by the moves are saved without a modification time, so an incremental scan lists them again
+#   and picks up any move that failed
+# It returns the folder structures, see get_folder_structures above
+def maintain_folder_structures(verbose=False, workers=8, dry_run=False, index=None):
+    print("\nGetting folder structure and moving artifacts and empty directories")
+    
+    folder_structures = dict()
+    plan = []
+    
+    for indir in os.listdir('Results'):
+        print("\nWorking on " + indir)
         
-    for topdir in os.listdir('Results'):
-        for dir_to_move in folder_dir_hashes[topdir]:
-            if folder_structures[topdir][dir_to_move]['error'] == 0:
-                if len(folder_dir_hashes[topdir][dir_to_move]) == len(folder_structures[topdir][dir_to_move]['tifs']):
-                                    
-                    for topdir2 in os.listdir('Results'):
-                        for dir_to_compare in folder_dir_hashes[topdir2]:
-                            
-                            if dir_to_move != dir_to_compare:
-                                if set(folder_dir_hashes[topdir][dir_to_move]).issubset(set(folder_dir_hashes[topdir2][dir_to_compare])):                                                         
-                                    
-                                    if os.path.isdir('//files.brown.edu/DFS/Library_DPS/' + dir_to_move) and os.path.isdir('//files.brown.edu/DFS/Library_DPS/' + dir_to_compare) :
-                                        root = '//files.brown.edu/DFS/Library_DPS/' + dir_to_move
-                                        
-                                        
-                                        print("".join(i for i in dir_to_move if ord(i)<128))
-                                        print("Contains %s files %s tifs" % (folder_structures[topdir][dir_to_move]['total_files'], folder_structures[topdir][dir_to_move]['total_tifs']))   
-                                        
-                                        print("".join(i for i in dir_to_compare if ord(i)<128))                                        
-                                        print("Contains %s files %s tifs" % (folder_structures[topdir2][dir_to_compare]['total_files'], folder_structures[topdir2][dir_to_compare]['total_tifs']))   
-                                        
-                                        gtg = True
-                                        for file in os.listdir(root):
-                                            if file[-4:] != ".tif" and file[-4:] != ".TIF":
-                                                if file != "._.DS_Store" and file != ".DS_Store" :
-                                                    if not os.path.isfile('//files.brown.edu/DFS/Library_DPS/' + dir_to_compare + '/' + file):
-                                                        gtg = False
-                                                        break
-                                        if gtg:
-
-                                            while True:
-                                                proceed = True
-                                                break
-                                                char = input("Proceed? Y/N/Q \n")
-                                                if (char == 'Y') or (char == 'y') :
-                                                    proceed = True
-                                                    break
-                                                if (char == 'N') or (char == 'n') :
-                                                    proceed = False
-                                                    break
-                                                if (char == 'Q') or (char == 'q') :
-                                                    return None, None
-                                                
-                                            if proceed :
-                                                print("Moving")
-                                                new_root = '//files.brown.edu/DFS/Library_DPS/MOVED/' + dir_to_move
-                                                
-                                                if not os.path.isdir(new_root):
-                                                    os.makedirs(new_root)
-                                                
-                                                for filename in os.listdir(root) :
-                                                    os.rename(root + "/" + filename, new_root + "/" + filename)
-                                                
-                                                os.rmdir(root)    
-                                                                                                
-                                                del folder_structures[topdir][dir_to_move]
-                                                del folder_dir_hashes[topdir][dir_to_move]
-                                                
-                                                with open("Results/" + topdir + "/folder_structure.csv", 'w', newline='') as csvfile:
-                                                    writer = csv.writer(csvfile, delimiter=',')
-                                                    writer.writerow(["Directory", "Error", "Contains Directories", "Total Files", "Total Tifs", "Tifs"])   
-                                                    folder_structure = folder_structures[topdir]
-                                                    for directory in folder_structure:
-                                                        row = ["".join(i for i in directory if ord(i)<128), folder_structure[directory]['error'], folder_structure[directory]['super_dir'], folder_structure[directory]['total_files'], folder_structure[directory]['total_tifs']] + folder_structure[directory]['tifs']
-                                                        writer.writerow(row)                                                   
-                                                
-                                                return folder_structures, folder_dir_hashes
-                                        else:
-                                            print("Not valid\n")
-    return None, None
+        folder_structures[indir] = dict()
+        removed = set()
+        artifacts = 0
+        empty_dirs = 0
         
-# This function removes all directories that are sub-sets or duplicates of other folders
-# If a directory contains only duplicate tifs but those dupliactes are spread accross multiple other directories, it is not removed
-# If a directory contains files besides tifs, files with the same names must exist in the other directory for it to be removed
-#   with the exception of "._.DS_Store" and ".DS_Store" files, which are ignored
-def move_duplicate_directories(local_checksums, folder_structures):   
-    print("\nMoving Duplicate Directories")
+        for root, dirs, files, mtime, file_sizes in walk_directory_tree(share_root + indir, workers):
+            
+            moved = []
+            for filename in files:
+                if (filename[-4:] == ".tif" or filename[-4:] == ".TIF") and filename[0:2] == '._':
+                    if filename not in file_sizes:
+                        print("Error: Could not read file size")
+                        print(root + "/" + filename)
+                    elif file_sizes[filename] < 1024*1024:
+                        moved.append(filename)
+                    else:
+                        print("FILE TOO BIG")
+                        print(root + "/" + filename)
+            
+            kept = [filename for filename in files if filename not in moved]
+            kept_dirs = [directory for directory in dirs if root + "/" + directory not in removed]
+            
+            directory = root[len(share_root):].replace("\\", "/")
+            
+            if len(dirs) == 0 and all(filename == "._.DS_Store" or filename == ".DS_Store" for filename in kept):
+                plan.extend(plan_empty_dir_move(root, files))
+                removed.add(root)
+                artifacts += len(moved)
+                empty_dirs += 1
+                if dry_run:
+                    add_directory(folder_structures[indir], directory, dirs, files, mtime, None, verbose, file_sizes)
+                continue
+            
+            if len(moved) > 0:
+                new_root = share_root + 'MOVED' + root[len(share_root)-1:]
+                plan.append(('makedirs', new_root, ""))
+                for filename in moved:
+                    plan.append(('rename', root + "/" + filename, new_root + "/" + filename))
+                artifacts += len(moved)
+            
+            if dry_run:
+                add_directory(folder_structures[indir], directory, dirs, files, mtime, None, verbose, file_sizes)
+            else:
+                if len(moved) > 0 or len(kept_dirs) < len(dirs):
+                    mtime = None
+                add_directory(folder_structures[indir], directory, kept_dirs, kept, mtime, None, verbose, file_sizes)
+        
+        print("Found %s artifacts and %s empty directories" % (artifacts, empty_dirs))
+    
+    run_move_plan(plan, 'maintenance', dry_run, workers)
+    
+    print("\nWriting results")
+    for indir in folder_structures:
+        save_folder_structure(indir, folder_structures[indir], index)
+    
+    return folder_structures
+            
+# This function generates the list of tif checksums of every directory
+# Directories containing a tif without a checksum are left out
+# It returns a dictionary: folder_dir_hashes
+#   The keys are the top level directories and the values are dictionaries
+#   The keys of these dictionaries are folder paths and the values are lists of checksums
+def get_folder_dir_hashes(local_checksums, folder_structures):
     folder_dir_hashes = dict()
     for topdir in folder_structures:
         folder_dir_hashes[topdir] = dict()
@@ -490,21 +1903,440 @@ def move_duplicate_directories(local_checksums, folder_structures):
                             break
                         else:
                             folder_dir_hashes[topdir][directory].append(local_checksums[filepath])  
+    return folder_dir_hashes
+
+# This function builds an inverted index of the directory checksums
+# It returns a dictionary: checksum_dirs
+#   The keys are checksums and the values are sets of (top level directory, directory) pairs containing that checksum
+def build_checksum_index(folder_dir_hashes):
+    checksum_dirs = dict()
+    for topdir in folder_dir_hashes:
+        for directory in folder_dir_hashes[topdir]:
+            for checksum in folder_dir_hashes[topdir][directory]:
+                if checksum not in checksum_dirs:
+                    checksum_dirs[checksum] = set()
+                checksum_dirs[checksum].add((topdir, directory))
+    return checksum_dirs
+
+# This function removes a directory from the inverted index so it is no longer offered as a superset
+def remove_from_checksum_index(checksum_dirs, key, checksums):
+    for checksum in set(checksums):
+        if checksum in checksum_dirs:
+            checksum_dirs[checksum].discard(key)
+            if len(checksum_dirs[checksum]) == 0:
+                del checksum_dirs[checksum]
+
+# This function finds every directory whose checksums are a superset of the given checksums
+# The posting lists are intersected from smallest to largest so the candidate set shrinks as fast as possible
+# It returns a set of (top level directory, directory) pairs, not including the directory itself
+def find_superset_directories(checksum_dirs, key, checksums):
+    postings = []
+    for checksum in set(checksums):
+        if checksum not in checksum_dirs:
+            return set()
+        postings.append(checksum_dirs[checksum])
+    if len(postings) == 0:
+        return set()
+    postings.sort(key=len)
+    
+    candidates = set(postings[0])
+    candidates.discard(key)
+    for posting in postings[1:]:
+        if len(candidates) == 0:
+            break
+        candidates &= posting
+    return candidates
+
+# This function generates the plan for move_duplicate_directories below
+# Every directory is compared against the inverted index once, and directories planned to be moved
+#   are removed from the index so they are not used as a superset for later directories
+# It returns a list of (top level directory, directory to move, top level directory, directory to compare, files) tuples
+#   where files lists the files in the directory to move
+def plan_duplicate_directory_moves(folder_structures, folder_dir_hashes):
+    
+    checksum_dirs = build_checksum_index(folder_dir_hashes)
+    
+    dir_order = dict()
+    for topdir in os.listdir('Results'):
+        for directory in folder_dir_hashes[topdir]:
+            dir_order[(topdir, directory)] = len(dir_order)
+    
+    plan = []
+    for topdir in os.listdir('Results'):
+        for dir_to_move in folder_dir_hashes[topdir]:
+            if folder_structures[topdir][dir_to_move]['error'] != 0:
+                continue
+            if len(folder_dir_hashes[topdir][dir_to_move]) != len(folder_structures[topdir][dir_to_move]['tifs']):
+                continue
+            
+            key = (topdir, dir_to_move)
+            candidates = find_superset_directories(checksum_dirs, key, folder_dir_hashes[topdir][dir_to_move])
+            
+            for topdir2, dir_to_compare in sorted(candidates, key=dir_order.get):
+                if os.path.isdir(share_root + dir_to_move) and os.path.isdir(share_root + dir_to_compare) :
+                    root = share_root + dir_to_move
+                    
+                    print("\n")
+                    print("".join(i for i in dir_to_move if ord(i)<128))
+                    print("Contains %s files %s tifs" % (folder_structures[topdir][dir_to_move]['total_files'], folder_structures[topdir][dir_to_move]['total_tifs']))   
+                    
+                    print("".join(i for i in dir_to_compare if ord(i)<128))                                        
+                    print("Contains %s files %s tifs" % (folder_structures[topdir2][dir_to_compare]['total_files'], folder_structures[topdir2][dir_to_compare]['total_tifs']))   
+                    
+                    gtg = True
+                    files = os.listdir(root)
+                    for file in files:
+                        if file[-4:] != ".tif" and file[-4:] != ".TIF":
+                            if file != "._.DS_Store" and file != ".DS_Store" :
+                                if not os.path.isfile(share_root + dir_to_compare + '/' + file):
+                                    gtg = False
+                                    break
+                    if gtg:
+                        plan.append((topdir, dir_to_move, topdir2, dir_to_compare, files))
+                        remove_from_checksum_index(checksum_dirs, key, folder_dir_hashes[topdir][dir_to_move])
+                        break
+                    else:
+                        print("Not valid\n")
+    return plan
         
-    while True :
-        print("\n")
-        folder_structures, folder_dir_hashes = move_duplicate_directories_helper(local_checksums, folder_structures, folder_dir_hashes)
-        if folder_structures is None : return
-       
-   
+# This function removes all directories that are sub-sets or duplicates of other folders
+# If a directory contains only duplicate tifs but those dupliactes are spread accross multiple other directories, it is not removed
+# If a directory contains files besides tifs, files with the same names must exist in the other directory for it to be removed
+#   with the exception of "._.DS_Store" and ".DS_Store" files, which are ignored
+# If "dry_run" is set the moves are only written to duplicates_plan.csv in the journal directory
+def move_duplicate_directories(local_checksums, folder_structures, dry_run=False, workers=8):   
+    print("\nMoving Duplicate Directories")
+    folder_dir_hashes = get_folder_dir_hashes(local_checksums, folder_structures)
+    
+    duplicates = plan_duplicate_directory_moves(folder_structures, folder_dir_hashes)
+    
+    plan = []
+    for topdir, dir_to_move, topdir2, dir_to_compare, files in duplicates:
+        root = share_root + dir_to_move
+        new_root = share_root + 'MOVED/' + dir_to_move
+        
+        plan.append(('makedirs', new_root, ""))
+        for filename in files :
+            plan.append(('rename', root + "/" + filename, new_root + "/" + filename))
+        plan.append(('rmdir', root, ""))
+    
+    print("Found %s duplicate directories" % len(duplicates))
+    failed = run_move_plan(plan, 'duplicates', dry_run, workers)
+    if dry_run:
+        return
+    # After a partial failure some of the directories are still on the share, the next scan updates the folder structure
+    if failed > 0:
+        print("Error: Some moves failed, the folder structure is not updated")
+        return
+    
+    changed = []
+    for topdir, dir_to_move, topdir2, dir_to_compare, files in duplicates:
+        del folder_structures[topdir][dir_to_move]
+        if topdir not in changed:
+            changed.append(topdir)
+    
+    for topdir in changed:
+        save_folder_structure(topdir, folder_structures[topdir])
+
+# This function computes a content hash for every directory of one top level directory, like a Merkle tree
+# The hash of a directory is the MD5 of its number of non-tif files, the sorted checksums of its tifs and the sorted hashes of its
+#   sub-directories, so two directory trees with the same tifs in the same layout get the same hash wherever they are and whatever they are called
+# Directories with errors or tifs without checksums can't be compared, so they and every directory above them get the hash None
+# It returns a dictionary: subtree_hashes
+#   The keys are folder paths and the values are (hash, tifs, directories) tuples with the total number of tifs and
+#   sub-directories in the whole tree
+def get_subtree_hashes(folder_structure, local_checksums):
+    children = dict()
+    for directory in folder_structure:
+        children[directory] = []
+    for directory in folder_structure:
+        parent = directory.rsplit("/", 1)[0]
+        if parent != directory and parent in children:
+            children[parent].append(directory)
+    
+    subtree_hashes = dict()
+    # Deeper directories first, so every sub-directory is hashed before its parent
+    for directory in sorted(folder_structure, key=lambda i: i.count("/"), reverse=True):
+        entry = folder_structure[directory]
+        tifs = entry['total_tifs']
+        directories = 0
+        
+        digests = []
+        if entry['error'] or directory[0:25] == "CDI_STORE_10/Photo_Shoots":
+            digests = None
+        else:
+            for filepath in entry['tifs']:
+                checksum = local_checksums.get(filepath)
+                if checksum is None:
+                    digests = None
+                    break
+                digests.append(checksum_digest(checksum) if isinstance(checksum, str) else checksum)
+        
+        child_hashes = []
+        for child in children[directory]:
+            child_hash, child_tifs, child_directories = subtree_hashes[child]
+            tifs += child_tifs
+            directories += child_directories + 1
+            if child_hash is None:
+                digests = None
+            child_hashes.append(child_hash)
+        
+        if digests is None:
+            subtree_hashes[directory] = (None, tifs, directories)
+        else:
+            md5 = hashlib.md5(b"%d:" % (entry['total_files'] - entry['total_tifs']))
+            for digest in sorted(digests):
+                md5.update(digest)
+            md5.update(b":")
+            for child_hash in sorted(child_hashes):
+                md5.update(child_hash)
+            subtree_hashes[directory] = (md5.digest(), tifs, directories)
+    
+    return subtree_hashes
+
+# This function finds directory trees that are identical to other directory trees, see get_subtree_hashes above
+# Only the top of each duplicate tree is listed: a tree inside a duplicate tree is left out because it is duplicated along with it
+# Trees without tifs are left out
+# It returns a list of groups of identical trees, each group a list of (top level directory, directory, tifs, directories) tuples
+#   Groups and the trees in each group are in the order of the folder structures
+def find_duplicate_trees(folder_structures, local_checksums):
+    subtree_hashes = dict()
+    hash_groups = dict()
+    for topdir in os.listdir('Results'):
+        subtree_hashes[topdir] = get_subtree_hashes(folder_structures[topdir], local_checksums)
+        for directory in folder_structures[topdir]:
+            tree_hash, tifs, directories = subtree_hashes[topdir][directory]
+            if tree_hash is not None and tifs > 0:
+                if tree_hash not in hash_groups:
+                    hash_groups[tree_hash] = []
+                hash_groups[tree_hash].append((topdir, directory, tifs, directories))
+    
+    groups = []
+    for tree_hash in hash_groups:
+        if len(hash_groups[tree_hash]) < 2:
+            continue
+        group = []
+        for topdir, directory, tifs, directories in hash_groups[tree_hash]:
+            parent = directory.rsplit("/", 1)[0]
+            if parent != directory and parent in subtree_hashes[topdir]:
+                parent_hash = subtree_hashes[topdir][parent][0]
+                if parent_hash is not None and len(hash_groups.get(parent_hash, [])) > 1:
+                    continue
+            group.append((topdir, directory, tifs, directories))
+        if len(group) > 1:
+            groups.append(group)
+    return groups
+
+# This function generates a duplicate_trees.csv file for each top level directory
+# It lists the top of every directory tree that is identical to another directory tree anywhere in the analyzed directories,
+#   with the total number of tifs and sub-directories in the tree, largest trees first
+# If "top" is given only the "top" largest trees are listed, and if "gzipped" is set the files are gzip compressed
+# The matching directories are written from the group of each tree, instead of being copied to a list for every tree
+def analyze_duplicate_trees(folder_structures, local_checksums, top=None, gzipped=False):
+    print("\nAnalyzing directories for duplicate trees")
+    
+    rows = dict()
+    for topdir in os.listdir('Results'):
+        rows[topdir] = []
+    for group in find_duplicate_trees(folder_structures, local_checksums):
+        for topdir, directory, tifs, directories in group:
+            rows[topdir].append((tifs, directories, directory, group))
+    
+    for topdir in rows:
+        if top is not None:
+            rows[topdir] = heapq.nlargest(top, rows[topdir], key=lambda i: (i[0], i[1], i[2]))
+        else:
+            rows[topdir].sort(key=lambda i: (i[0], i[1], i[2]), reverse=True)
+        with open_report('Results/' + topdir + '/duplicate_trees.csv', gzipped) as csvfile:
+            writer = csv.writer(csvfile, delimiter=',')
+            writer.writerow(["Directory", "Total Tifs", "Total Sub-directories", "Matches", "Matching Directories"])
+            for tifs, directories, directory, group in rows[topdir]:
+                writer.writerow(chain([directory, tifs, directories, len(group) - 1], (i[1] for i in group if i[1] != directory)))
+        print("Found %s duplicate trees in %s" % (len(rows[topdir]), topdir))
+
+# This function returns the non-tif files of a directory tree, for move_duplicate_trees below
+# "._.DS_Store" and ".DS_Store" files are ignored
+# It returns a Counter of (name, size) tuples
+def get_tree_other_files(root):
+    other_files = Counter()
+    for dirpath, dirs, files in os.walk(root):
+        for file in files:
+            if file[-4:] != ".tif" and file[-4:] != ".TIF" and file != "._.DS_Store" and file != ".DS_Store":
+                try:
+                    other_files[(file, os.path.getsize(dirpath + "/" + file))] += 1
+                except OSError:
+                    other_files[(file, None)] += 1
+    return other_files
+
+# This function removes whole directory trees that are identical to another directory tree, see find_duplicate_trees above
+# The first tree of each group is kept and every other tree is moved with a single rename
+# The tree hashes only compare the number of non-tif files, so a tree is only moved if every one of its non-tif files has a file
+#   with the same name and size in the kept tree, with the exception of "._.DS_Store" and ".DS_Store" files, which are ignored
+# If "dry_run" is set the moves are only written to duplicate_trees_plan.csv in the journal directory
+def move_duplicate_trees(local_checksums, folder_structures, dry_run=False, workers=8):
+    print("\nMoving Duplicate Trees")
+    
+    plan = []
+    new_roots = set()
+    moved = []
+    for group in find_duplicate_trees(folder_structures, local_checksums):
+        keep_topdir, keep_directory = group[0][0], group[0][1]
+        if not os.path.isdir(share_root + keep_directory):
+            continue
+        kept_files = get_tree_other_files(share_root + keep_directory)
+        
+        for topdir, directory, tifs, directories in group[1:]:
+            # Top level directories are never moved
+            if directory == topdir or not os.path.isdir(share_root + directory):
+                continue
+            
+            print("".join(i for i in directory if ord(i)<128))
+            print("Contains %s tifs in %s sub-directories, same as" % (tifs, directories))
+            print("".join(i for i in keep_directory if ord(i)<128))
+            
+            other_files = get_tree_other_files(share_root + directory)
+            if any(other_files[i] > kept_files[i] for i in other_files):
+                print("Not valid\n")
+                continue
+            
+            new_root = share_root + 'MOVED/' + directory
+            if os.path.dirname(new_root) not in new_roots:
+                new_roots.add(os.path.dirname(new_root))
+                plan.append(('makedirs', os.path.dirname(new_root), ""))
+            plan.append(('rename', share_root + directory, new_root))
+            moved.append((topdir, directory))
+    
+    print("Found %s duplicate trees" % len(moved))
+    failed = run_move_plan(plan, 'duplicate_trees', dry_run, workers)
+    if dry_run:
+        return
+    # After a partial failure some of the trees are still on the share, the next scan updates the folder structure
+    if failed > 0:
+        print("Error: Some moves failed, the folder structure is not updated")
+        return
+    
+    changed = []
+    for topdir, directory in moved:
+        for subdirectory in list(folder_structures[topdir]):
+            if subdirectory == directory or subdirectory.startswith(directory + "/"):
+                del folder_structures[topdir][subdirectory]
+        if topdir not in changed:
+            changed.append(topdir)
+    
+    for topdir in changed:
+        save_folder_structure(topdir, folder_structures[topdir])
+
+# This function converts a checksum to the 16 byte digest hashed by minhash_signature below
+def checksum_bytes(checksum):
+    if isinstance(checksum, str):
+        checksum = checksum_digest(checksum)
+        if isinstance(checksum, str):
+            checksum = hashlib.md5(checksum.encode('utf-8')).digest()
+    return checksum
+
+# This function computes the MinHash signature of a set of checksums
+# Each checksum is hashed once with SHAKE-128 into "num_perm" independent 64 bit values, one for each hash function,
+#   and the signature keeps the smallest value of each hash function over the set
+# Two sets agree at any position of their signatures with probability equal to their Jaccard similarity
+def minhash_signature(checksums, num_perm, seed=b""):
+    columns = [array.array('Q', hashlib.shake_128(seed + checksum_bytes(i)).digest(8*num_perm)) for i in checksums]
+    return tuple(map(min, zip(*columns)))
+
+# This function chooses how to split a MinHash signature into bands for locality-sensitive hashing
+# Pairs of directories that agree in all rows of at least one band become candidates, which happens for similarity s with
+#   probability 1 - (1 - s^rows)^bands. The split with the most rows per band (the fewest dissimilar candidates) that still
+#   finds at least "recall" of the pairs right at the threshold is chosen
+# It returns a tuple (bands, rows)
+def choose_lsh_bands(num_perm, threshold, recall=0.95):
+    best = (num_perm, 1)
+    for rows in range(1, num_perm + 1):
+        bands = num_perm // rows
+        if 1 - (1 - threshold ** rows) ** bands >= recall:
+            best = (bands, rows)
+    return best
+
+# This function finds pairs of directories whose tif checksums overlap by at least "threshold", measured by Jaccard similarity
+# Directories are bucketed by bands of their MinHash signatures (see above), so only directories sharing a bucket are compared
+#   and the work grows close to linearly with the number of directories. Every candidate pair is then checked exactly
+# It takes a folder_dir_hashes dictionary, see get_folder_dir_hashes above
+# It returns a list of (similarity, shared tifs, (top level directory, directory), (top level directory, directory)) tuples,
+#   most similar first
+def find_near_duplicate_directories(folder_dir_hashes, threshold=0.9, num_perm=128, seed=1):
+    bands, rows = choose_lsh_bands(num_perm, threshold)
+    print("Using %s bands of %s rows" % (bands, rows))
+    
+    dir_sets = dict()
+    buckets = dict()
+    for topdir in folder_dir_hashes:
+        for directory in folder_dir_hashes[topdir]:
+            checksums = set(folder_dir_hashes[topdir][directory])
+            if len(checksums) == 0:
+                continue
+            key = (topdir, directory)
+            dir_sets[key] = checksums
+            signature = minhash_signature(checksums, num_perm, b"%d:" % seed)
+            for band in range(bands):
+                bucket = (band, signature[band*rows:(band+1)*rows])
+                if bucket not in buckets:
+                    buckets[bucket] = []
+                buckets[bucket].append(key)
+    
+    candidates = set()
+    for bucket in buckets:
+        keys = buckets[bucket]
+        for i in range(len(keys)):
+            for j in range(i + 1, len(keys)):
+                candidates.add((keys[i], keys[j]))
+    print("Checking %s candidate pairs of %s directories" % (len(candidates), len(dir_sets)))
+    
+    pairs = []
+    for key1, key2 in candidates:
+        shared = len(dir_sets[key1] & dir_sets[key2])
+        similarity = shared / (len(dir_sets[key1]) + len(dir_sets[key2]) - shared)
+        if similarity >= threshold:
+            pairs.append((similarity, shared, key1, key2))
+    pairs.sort(key=lambda i: (-i[0], -i[1], i[2], i[3]))
+    return pairs
+
+# This function generates a near_duplicate_directories.csv file for each top level directory
+# It lists every directory whose tifs overlap with another directory's tifs by at least "threshold" (Jaccard similarity),
+#   most similar first, see find_near_duplicate_directories above. A pair in two top level directories is listed in both files
+# If "gzipped" is set the files are gzip compressed
+def analyze_near_duplicate_directories(folder_structures, local_checksums, threshold=0.9, num_perm=128, gzipped=False):
+    print("\nAnalyzing directories for near duplicates")
+    
+    folder_dir_hashes = get_folder_dir_hashes(local_checksums, folder_structures)
+    pairs = find_near_duplicate_directories(folder_dir_hashes, threshold, num_perm)
+    
+    rows = dict()
+    for topdir in os.listdir('Results'):
+        rows[topdir] = []
+    for similarity, shared, key1, key2 in pairs:
+        for (topdir, directory), (topdir2, match) in ((key1, key2), (key2, key1)):
+            if topdir in rows:
+                rows[topdir].append((similarity, shared, directory, match))
+    
+    for topdir in rows:
+        with open_report('Results/' + topdir + '/near_duplicate_directories.csv', gzipped) as csvfile:
+            writer = csv.writer(csvfile, delimiter=',')
+            writer.writerow(["Directory", "Error", "Contains Directories", "Total Files", "Total Tifs", "Matching Directory", "Shared Tifs", "Percent Similar"])
+            for similarity, shared, directory, match in rows[topdir]:
+                entry = folder_structures[topdir][directory]
+                writer.writerow([directory, "Yes" if entry['error'] else " ", "Yes" if entry['super_dir'] else " ", entry['total_files'], entry['total_tifs'], match, shared, "%02f%%" % (similarity*100)])
+        print("Found %s near duplicate directories in %s" % (len(rows[topdir]), topdir))
 
 # This function removes all directories that contain only injested tifs
 # If the folder contains files besides tifs they are left behind in the directory
-def move_injested_directories(folder_structures, local_checksums):
+# If "dry_run" is set the moves are only written to injested_plan.csv in the journal directory
+# Directories with tifs in "mismatches" are left in place, see read_checksum_mismatches below
+def move_injested_directories(folder_structures, local_checksums, bdr_checksums, dry_run=False, workers=8, mismatches=None):
     print("\nMoving Injested Directories")
     
+    plan = []
     for indir in os.listdir('Results'):
         print("\nWorking on " + indir)    
+        
+        bdr_found = lookup_bdr_checksums(bdr_checksums, get_folder_checksums(folder_structures[indir], local_checksums))
 
         moved = 0        
         for directory in folder_structures[indir]:
@@ -512,57 +2344,928 @@ def move_injested_directories(folder_structures, local_checksums):
             for filepath in folder_structures[indir][directory]['tifs']:
                 if filepath in local_checksums:
                     checksum = local_checksums[filepath]
-                    if checksum is not None and checksum in bdr_checksums:
+                    if checksum is not None and checksum in bdr_found:
                         injested += 1
                 else:
                     print("Error: File not found")
                     print(filepath)                        
             if injested > 0 and injested == len(folder_structures[indir][directory]['tifs']):
+                if mismatches is not None and any(filepath in mismatches[indir] for filepath in folder_structures[indir][directory]['tifs']):
+                    print("Error: Checksums do not match, skipping")
+                    print(directory)
+                    continue
                 moved += 1
                 
-                if not os.path.isdir('//files.brown.edu/DFS/Library_DPS/MOVED/' + directory):
-                    os.makedirs('//files.brown.edu/DFS/Library_DPS/MOVED/' + directory)
+                plan.append(('makedirs', share_root + 'MOVED/' + directory, ""))
                 
                 for filepath in folder_structures[indir][directory]['tifs']:
-                    old_filepath = '//files.brown.edu/DFS/Library_DPS/' + filepath
-                    new_filepath = '//files.brown.edu/DFS/Library_DPS/MOVED/' + filepath
+                    old_filepath = share_root + filepath
+                    new_filepath = share_root + 'MOVED/' + filepath
                     
-                    if os.path.isfile(old_filepath):
-                        os.rename(old_filepath, new_filepath)                
+                    plan.append(('rename', old_filepath, new_filepath))
             
-        print("Moved %s directories" % moved)
+        print("Found %s directories" % moved)
+    
+    run_move_plan(plan, 'injested', dry_run, workers)
+    
+
+# The functions below check that the checksums in the local checksum files still match the tifs on the share, see verify_checksums
+# Re-hashing the share at full speed would slow it down for everyone else, so the tifs are read at a capped rate by a number
+#   of threads that is lowered when the share gets slower and raised again when it recovers
+
+# The name of the csv file verify_checksums writes to the results directory of each top level directory
+mismatch_file_name = 'checksum_mismatches.csv'
+
+# This class caps the rate files are read at, it is shared by the threads of verify_checksums below
+# Each read is given a time slot after the slot of the last read and waits for the end of its slot, so reads are spread out
+#   evenly between the threads
+class ReadThrottle:
+    
+    # "bytes_per_second" is the cap, 0 for no cap
+    def __init__(self, bytes_per_second):
+        self.bytes_per_second = bytes_per_second
+        self.next_read = time.monotonic()
+        self.lock = threading.Lock()
+    
+    # Waits until the "length" bytes just read are within the cap
+    def wait(self, length):
+        if self.bytes_per_second <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.next_read = max(self.next_read, now) + length / self.bytes_per_second
+            end = self.next_read
+        time.sleep(end - now)
+
+# This class limits the number of files read at once, it is shared by the threads of verify_checksums below
+# The time of each read is averaged, and the lowest average seen is taken as the time of a read on an idle share
+# Each time as many files as the limit have been read, the limit is halved if the average is more than "slowdown" times
+#   the lowest average, and raised by one otherwise, between 1 and "maximum"
+class AdaptiveConcurrency:
+    
+    def __init__(self, maximum, slowdown=2.0):
+        self.maximum = maximum
+        self.slowdown = slowdown
+        self.limit = max(1, maximum // 2)
+        self.active = 0
+        self.finished = 0
+        self.average = None
+        self.lowest = None
+        self.changes = 0
+        self.condition = threading.Condition()
+    
+    # Waits until another file can be read
+    def acquire(self):
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+    
+    # Records that a file was read, "latency" is the average time in seconds of its reads, None if it could not be read
+    def release(self, latency=None):
+        with self.condition:
+            self.active -= 1
+            if latency is not None:
+                self.average = latency if self.average is None else 0.8*self.average + 0.2*latency
+                self.lowest = self.average if self.lowest is None else min(self.lowest, self.average)
+                self.finished += 1
+            if self.finished >= self.limit:
+                self.finished = 0
+                if self.average > self.slowdown * self.lowest:
+                    limit = max(1, self.limit // 2)
+                else:
+                    limit = min(self.maximum, self.limit + 1)
+                if limit != self.limit:
+                    self.limit = limit
+                    self.changes += 1
+            self.condition.notify_all()
+
+# This function computes the MD5 checksum of a file like hash_file above, reading it through a ReadThrottle and an
+#   AdaptiveConcurrency. Smaller blocks are read so the throttle can spread the reads out, and only the time spent reading
+#   is counted as the latency of the file
+# It returns a tuple (filepath, checksum, size), with a None checksum if the file could not be read
+def hash_file_throttled(filepath, throttle, concurrency, block_size=1024*1024):
+    md5 = hashlib.md5()
+    size = 0
+    reads = 0
+    read_time = 0.0
+    buffer = bytearray(block_size)
+    view = memoryview(buffer)
+    concurrency.acquire()
+    try:
+        with open(share_root + filepath, 'rb', buffering=0) as f:
+            while True:
+                start = time.perf_counter()
+                length = f.readinto(buffer)
+                read_time += time.perf_counter() - start
+                reads += 1
+                if not length:
+                    break
+                md5.update(view[:length])
+                size += length
+                throttle.wait(length)
+    except OSError:
+        concurrency.release()
+        return filepath, None, size
+    concurrency.release(read_time / reads)
+    return filepath, md5.hexdigest().upper(), size
+
+# This function picks the tifs of one top level directory to verify, see verify_checksums below
+# The tifs are sampled by directory so every directory is checked: "fraction" of the tifs with a checksum in each directory
+#   are picked at random, and at least one
+# It returns a list of (directory, filepath) tuples
+def sample_verification_files(folder_structure, file_checksums, fraction, rnd):
+    sample = []
+    for directory in folder_structure:
+        tifs = [filepath for filepath in folder_structure[directory]['tifs'] if filepath in file_checksums]
+        if len(tifs) == 0:
+            continue
+        if fraction < 1:
+            tifs = rnd.sample(tifs, max(1, math.ceil(fraction * len(tifs))))
+        sample.extend((directory, filepath) for filepath in tifs)
+    return sample
+
+# This function hashes tifs again and compares them with the checksums in the local checksum files, so moves are not made
+#   on the strength of checksums that are out of date
+# "bandwidth" is the cap on the rate files are read at in bytes per second, 0 for no cap, and at most "workers" files are
+#   read at once, see ReadThrottle and AdaptiveConcurrency above
+# "fraction" is the share of the tifs of each directory that are verified, see sample_verification_files above, and
+#   "seed" seeds the sample, None for a different sample on every run
+# If an "index" connection is given the local checksum files are read from the index
+# The tifs that don't match or could not be read are written to the checksum_mismatches.csv file of each top level directory,
+#   see read_checksum_mismatches below. Tifs listed by earlier runs stay listed unless they were verified again and now match
+# It returns the number of tifs verified
+def verify_checksums(folder_structures, bandwidth, workers=8, fraction=1.0, seed=None, index=None):
+    print("\nVerifying Local Checksums")
+    
+    if index is not None:
+        index_local_checksums(index)
+        file_checksums = dict(index.execute("SELECT path, checksum FROM local_checksums"))
+    else:
+        file_checksums = read_local_checksum_files()
+    
+    rnd = random.Random(seed)
+    throttle = ReadThrottle(bandwidth)
+    concurrency = AdaptiveConcurrency(workers)
+    verified = 0
+    
+    for indir in os.listdir('Results'):
+        print("\nWorking on " + indir)
+        
+        sample = sample_verification_files(folder_structures[indir], file_checksums, fraction, rnd)
+        directories = dict((filepath, directory) for directory, filepath in sample)
+        
+        mismatches = []
+        total_bytes = 0
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for filepath, checksum, size in executor.map(hash_file_throttled, directories, [throttle]*len(sample), [concurrency]*len(sample)):
+                total_bytes += size
+                if checksum is None:
+                    print("Error: Could not read file")
+                    print(filepath)
+                    mismatches.append([directories[filepath], filepath, file_checksums[filepath], ""])
+                elif checksum != file_checksums[filepath]:
+                    print("Error: Checksum does not match")
+                    print(filepath)
+                    mismatches.append([directories[filepath], filepath, file_checksums[filepath], checksum])
+        elapsed = time.time() - start
+        verified += len(sample)
         
+        print("Verified %s tifs, %s do not match" % (len(sample), len(mismatches)))
+        print("Read %.1f MB in %.1f seconds: %.1f MB/s, reading %s files at once" % (total_bytes/(1024*1024), elapsed, total_bytes/(1024*1024)/max(elapsed, 1e-6), concurrency.limit))
+        
+        earlier = [row for row in read_mismatch_rows(indir) if row[1] not in directories]
+        if len(earlier) > 0:
+            print("%s tifs listed by earlier runs were not verified again and stay listed" % len(earlier))
+        mismatches = earlier + mismatches
+        
+        with open("Results/" + indir + "/" + mismatch_file_name, 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile, delimiter=',')
+            writer.writerow(["Directory", "File", "Listed Checksum", "Computed Checksum"])
+            for row in mismatches:
+                writer.writerow(row)
     
+    print("\nChanged the number of files read at once %s times" % concurrency.changes)
+    return verified
 
-if __name__ == '__main__':    
+# This function reads the checksum_mismatches.csv file of one top level directory written by verify_checksums above
+# It returns a list of [directory, file, listed checksum, computed checksum] rows, empty if there is no file
+def read_mismatch_rows(indir):
+    rows = []
+    file_name = "Results/" + indir + "/" + mismatch_file_name
+    if os.path.isfile(file_name):
+        with open(file_name, newline='') as csv_file:
+            csv_reader = csv.reader(csv_file, delimiter=',')
+            next(csv_reader, None)
+            for row in csv_reader:
+                rows.append(row)
+    return rows
 
-    # Get BDR checksums
-    bdr_checksums = get_bdr_checksums()
+# This function reads the checksum_mismatches.csv files written by verify_checksums above
+# It returns a dictionary with the top level directories as keys and dictionaries as values
+#   The keys are the tifs that don't match their local checksum and the values are their directories
+def read_checksum_mismatches(indirs):
+    mismatches = dict()
+    for indir in indirs:
+        mismatches[indir] = dict()
+        for row in read_mismatch_rows(indir):
+            mismatches[indir][row[1]] = row[0]
+    return mismatches
+
+# This function marks the directories with tifs that don't match their local checksum as errors in the folder structures,
+#   so they are listed as errors and duplicate moves skip them
+def mark_mismatched_directories(folder_structures, mismatches):
+    for indir in mismatches:
+        for directory in mismatches[indir].values():
+            if directory in folder_structures[indir]:
+                folder_structures[indir][directory]['error'] = 1
+
+
+# The functions below measure each stage of a run of run_phases: its wall and CPU time, the peak memory use of the process,
+#   the number of file system calls made on the share, the number of bytes read and the number of items processed
+# File system calls and bytes read are counted for the main process and its threads, not for worker processes
+# The file system functions are only replaced while a stage of run_phases runs, see start_stage below
+
+# The file system functions counted by count_file_system_calls below
+# os.walk, os.makedirs and the os.path functions call these, so their calls are counted as well
+counted_function_names = ['scandir', 'stat', 'lstat', 'listdir', 'mkdir', 'rename', 'rmdir']
+
+# The number of calls made to each file system function on the share, see count_file_system_calls below
+file_system_calls = Counter()
+file_system_calls_lock = threading.Lock()
+
+# This function returns a version of a file system function that counts its calls on the share
+def count_calls(function, name):
+    def counted(*args, **kwargs):
+        if len(args) > 0 and isinstance(args[0], str) and args[0].startswith(share_root):
+            with file_system_calls_lock:
+                file_system_calls[name] += 1
+        return function(*args, **kwargs)
+    return counted
+
+# This function starts counting the calls made on the share to the functions listed above and to open
+# It returns the original functions, to be restored with stop_counting_file_system_calls below
+def count_file_system_calls():
+    originals = dict()
+    for name in counted_function_names:
+        originals[name] = getattr(os, name)
+        setattr(os, name, count_calls(originals[name], name))
+    originals['open'] = builtins.open
+    builtins.open = count_calls(originals['open'], 'open')
+    return originals
+
+# This function restores the functions replaced by count_file_system_calls above
+def stop_counting_file_system_calls(originals):
+    for name in originals:
+        if name == 'open':
+            builtins.open = originals[name]
+        else:
+            setattr(os, name, originals[name])
+
+# This function returns the CPU time used by the process and its finished worker processes, in seconds
+def cpu_time():
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+# This function returns a tuple (peak, children peak) with the peak memory use in bytes of the process since it started and of
+#   its largest finished worker process, or None where it is not known
+def peak_memory():
+    if resource is not None:
+        scale = 1 if sys.platform == 'darwin' else 1024
+        return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale)
+    if sys.platform == 'win32':
+        import ctypes
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [('cb', ctypes.c_ulong), ('PageFaultCount', ctypes.c_ulong), ('PeakWorkingSetSize', ctypes.c_size_t),
+                        ('WorkingSetSize', ctypes.c_size_t), ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                        ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        if ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb):
+            return counters.PeakWorkingSetSize, None
+    return None, None
+
+# This function returns the number of bytes read by the process from files and the network, or None if it is not known
+def bytes_read():
+    if os.path.isfile('/proc/self/io'):
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    if sys.platform == 'win32':
+        import ctypes
+        counters = (ctypes.c_ulonglong * 6)()
+        if ctypes.windll.kernel32.GetProcessIoCounters(ctypes.windll.kernel32.GetCurrentProcess(), ctypes.byref(counters)):
+            return counters[3]
+    return None
+
+# This class is a sampling profiler: a thread that records the stack of every other thread every "interval" seconds
+# Each sample is recorded under the stage that was running, see start_stage below
+# Pool threads that are waiting for work are left out
+# The samples are saved as collapsed stacks, one "stage;caller;...;function count" line per stack, which flame graph tools read
+class SamplingProfiler:
     
-    # Get the folder structure
-    # Force re-generation in case changes were made
-    folder_structures = get_folder_structures(False, False)
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.stage = "start"
+        self.samples = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
     
-    # Get local checksums
-    local_checksums_fwd, local_checksums_bwd = get_local_checksums(folder_structures)
+    def start(self):
+        self.thread.start()
     
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
     
+    def sample(self):
+        own_thread = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread or (frame.f_code.co_name == '_worker' and os.path.basename(frame.f_code.co_filename) == 'thread.py'):
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append("%s:%s" % (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name))
+                    frame = frame.f_back
+                self.samples[self.stage + ";" + ";".join(reversed(stack))] += 1
     
-    # Comment or uncomment lines below to change the behavior of the script.
-    # To avoid unexpected behavior, don't uncomment move_injested_directories and move_duplicate_directories simultaneously, and do not change the order of the lines
+    def save(self, file_name):
+        with open(file_name, 'w') as f:
+            for stack, count in self.samples.most_common():
+                f.write("%s %s\n" % (stack, count))
+
+# This function starts measuring a stage, see end_stage below
+# "metrics" is the dictionary made by run_phases below. If its 'originals' key is set, the calls made on the share are counted
+#   until end_stage by replacing the file system functions, see count_file_system_calls above. Other callers, like
+#   refresh_queries, leave the functions alone
+# It returns the measurements at the start of the stage
+def start_stage(metrics, name):
+    if metrics['profiler'] is not None:
+        metrics['profiler'].stage = name
+    if 'originals' in metrics and metrics['originals'] is None:
+        metrics['originals'] = count_file_system_calls()
+    with file_system_calls_lock:
+        calls = Counter(file_system_calls)
+    return {'stage': name, 'wall': time.perf_counter(), 'cpu': cpu_time(), 'calls': calls, 'bytes': bytes_read(), 'peak': peak_memory()[0]}
+
+# This function finishes measuring a stage started with start_stage above and adds its metrics to "metrics"
+# "items" is the number of items the stage processed, eg tifs or directories, or None
+# The peak memory use is the peak of the whole process up to the end of the stage, not of the stage alone. The increase is how
+#   far the stage raised that peak, so it is 0 for a stage that stayed below the peak of an earlier stage
+def end_stage(metrics, start, items=None):
+    if metrics.get('originals') is not None:
+        stop_counting_file_system_calls(metrics['originals'])
+        metrics['originals'] = None
+    with file_system_calls_lock:
+        calls = Counter(file_system_calls)
+    calls.subtract(start['calls'])
+    end_bytes = bytes_read()
+    peak, children_peak = peak_memory()
+    stage = {'stage': start['stage'],
+             'wall_seconds': round(time.perf_counter() - start['wall'], 3),
+             'cpu_seconds': round(cpu_time() - start['cpu'], 3),
+             'process_peak_rss_bytes': peak,
+             'peak_rss_increase_bytes': None if peak is None or start['peak'] is None else peak - start['peak'],
+             'children_process_peak_rss_bytes': children_peak,
+             'file_system_calls': sum(calls.values()),
+             'file_system_calls_by_function': {name: calls[name] for name in sorted(calls) if calls[name] > 0},
+             'bytes_read': None if end_bytes is None or start['bytes'] is None else end_bytes - start['bytes'],
+             'items': items}
+    metrics['stages'].append(stage)
+    if metrics['profiler'] is not None:
+        metrics['profiler'].stage = "between stages"
+    print("%s: %.1f seconds, %.1f seconds of CPU, %s file system calls" % (stage['stage'], stage['wall_seconds'], stage['cpu_seconds'], stage['file_system_calls']))
+
+# This function writes the metrics of a run to metrics_<time>.json in the metrics directory, and the profile to profile_<time>.txt
+def save_metrics(metrics):
+    if not os.path.isdir(metrics_dir_name):
+        os.makedirs(metrics_dir_name)
+    name = metrics_dir_name + '/metrics_' + metrics['started']
+    metrics['wall_seconds'] = round(time.perf_counter() - metrics['start'], 3)
+    with open(name + '.json', 'w') as f:
+        json.dump({key: metrics[key] for key in ['started', 'arguments', 'wall_seconds', 'stages']}, f, indent=2)
+    print("\nMetrics saved to " + name + ".json")
+    if metrics['profiler'] is not None:
+        metrics['profiler'].save(metrics_dir_name + '/profile_' + metrics['started'] + '.txt')
+        print("Profile saved to " + metrics_dir_name + '/profile_' + metrics['started'] + '.txt')
+
+# The functions below answer lookups from a long running process that keeps the checksums and folder structures loaded, see serve_queries
+# "state" is the dictionary returned by run_stages below. Each function takes a list of values and returns a dictionary with
+#   an answer for each value
+
+# This function returns the hex form of a checksum from a checksum dictionary, which may be a 16 byte digest
+def checksum_hex(checksum):
+    return checksum.hex().upper() if isinstance(checksum, bytes) else checksum
+
+# This function returns a file path relative to the share, the way the folder structures store it
+def query_path(filepath):
+    filepath = filepath.replace("\\", "/")
+    if filepath.startswith(share_root):
+        filepath = filepath[len(share_root):]
+    return filepath
+
+# This function looks up checksums in the BDR, the answer for each checksum is its list of BDR numbers, empty if it is not in the BDR
+def query_bdr(state, checksums):
+    found = lookup_bdr_checksums(state['bdr_checksums'], [checksum.upper() for checksum in checksums])
+    return {checksum: found.get(checksum.upper(), []) for checksum in checksums}
+
+# This function looks up the scanned tifs with each checksum
+def query_files(state, checksums):
+    answers = dict()
+    for checksum in checksums:
+        key = checksum.upper()
+        if key not in state['local_checksums_fwd']:
+            key = checksum_digest(key)
+        answers[checksum] = checksum_entries(state['local_checksums_fwd'], key) if key in state['local_checksums_fwd'] else []
+    return answers
+
+# This function looks up the checksum of each tif and the other tifs with the same checksum
+# The answer is None for tifs that were not scanned, and has a None checksum for tifs without a checksum
+def query_duplicates(state, filepaths):
+    answers = dict()
+    for filepath in filepaths:
+        path = query_path(check_filename(filepath, False) or filepath)
+        if path not in state['local_checksums_bwd']:
+            answers[filepath] = None
+            continue
+        checksum = state['local_checksums_bwd'][path]
+        matches = [] if checksum is None else [i for i in checksum_entries(state['local_checksums_fwd'], checksum) if i != path]
+        answers[filepath] = {'checksum': None if checksum is None else checksum_hex(checksum), 'duplicates': matches}
+    return answers
+
+# This function returns the folder trees of a state, building them the first time they are looked up, see build_folder_trees above
+def get_folder_trees(state):
+    if state['folder_trees'] is None:
+        state['folder_trees'] = build_folder_trees(state['folder_structures'], state['directory_counts'])
+    return state['folder_trees']
+
+# This function looks up how much of each directory tree is injested or duplicated, see FolderNode above
+# The answer is None for directories that were not scanned
+def query_directories(state, directories):
+    answers = dict()
+    for directory in directories:
+        node = find_folder_node(get_folder_trees(state), query_path(directory))
+        if node is None:
+            answers[directory] = None
+            continue
+        answers[directory] = {'directories': node.tree_dirs, 'files': node.tree_files, 'tifs': node.tree_tifs,
+                              'injested': node.tree_injested, 'duplicates': node.tree_duplicates, 'errors': node.tree_errors,
+                              'percent_injested': 100 * node.tree_injested / node.tree_tifs if node.tree_tifs > 0 else None,
+                              'percent_duplicates': 100 * node.tree_duplicates / node.tree_tifs if node.tree_tifs > 0 else None}
+    return answers
+
+# The lookups answered by serve_queries: the path of each lookup, with the names of its values and the function that answers it
+# A lookup is made with a GET request that repeats the singular name, eg /bdr?checksum=...&checksum=...,
+#   or a POST request with a JSON object that holds a list under the plural name, eg {"checksums": [...]}
+query_functions = {'/bdr': ('checksum', 'checksums', query_bdr),
+                   '/files': ('checksum', 'checksums', query_files),
+                   '/duplicates': ('path', 'paths', query_duplicates),
+                   '/directories': ('directory', 'directories', query_directories)}
+
+# This class handles the requests made to serve_queries below
+# The server holds the current state in server.state, which is replaced as a whole when it is refreshed
+class QueryHandler(BaseHTTPRequestHandler):
+    
+    def send_json(self, status, answer):
+        body = json.dumps(answer).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def answer(self, path, values):
+        state = self.server.state
+        if path == '/status':
+            self.send_json(200, {'loaded': state['loaded'], 'stores': len(state['folder_structures']),
+                                 'tifs': len(state['local_checksums_bwd']), 'checksums': len(state['local_checksums_fwd']),
+                                 'bdr_checksums': len(state['bdr_checksums'])})
+        elif path in query_functions:
+            self.send_json(200, query_functions[path][2](state, values))
+        else:
+            self.send_json(404, {'error': "Unknown lookup " + path + ", use one of /status " + " ".join(query_functions)})
+    
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        name = query_functions[url.path][0] if url.path in query_functions else None
+        self.answer(url.path, urllib.parse.parse_qs(url.query).get(name, []))
     
-    # Generate bdr collision csv file
-    analyze_dir_bdr_collisions(folder_structures, local_checksums_bwd, bdr_checksums) 
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b"{}")
+        except ValueError:
+            self.send_json(400, {'error': "The request must be a JSON object"})
+            return
+        name = query_functions[url.path][1] if url.path in query_functions else None
+        if not isinstance(request, dict) or not isinstance(request.get(name, []), list) or not all(isinstance(i, str) for i in request.get(name, [])):
+            self.send_json(400, {'error': "The request must be a JSON object with a list of %s as strings" % name})
+            return
+        self.answer(url.path, request.get(name, []))
     
-    # Generate local collision csv file
-    analyze_dir_local_collisions(folder_structures, local_checksums_fwd, local_checksums_bwd)
+    # Unix sockets have no client address
+    def address_string(self):
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "local"
     
-    # Move injested directories
-#    move_injested_directories(folder_structures, local_checksums_bwd)
+    def log_message(self, format, *args):
+        pass
 
-    # Move duplicate directories
-#    move_duplicate_directories(local_checksums_bwd, folder_structures)    
+# This class is a threaded HTTP server listening on a Unix socket instead of a TCP port
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+# This function refreshes the state of a running server every "interval" seconds, see serve_queries below
+# The stages are run again with the same options: results whose inputs have not changed are kept, and the scan, if it was
+#   selected, only lists directories that changed. The new state replaces the old one when it is complete
+def refresh_queries(server, args, interval):
+    refresh_args = argparse.Namespace(**vars(args))
+    refresh_args.phases = [phase for phase in args.phases if phase == 'scan'] + ['analyze']
+    refresh_args.move = []
+    refresh_args.summary = []
+    refresh_args.maintain = False
+    refresh_args.no_cache = False
+    while True:
+        time.sleep(interval)
+        print("\nRefreshing")
+        try:
+            server.state = run_stages(refresh_args, {'stages': [], 'profiler': None}, server.state)
+        except Exception as error:
+            print("Error: Refresh failed")
+            print(error)
+
+# This function answers lookups about the loaded checksums and folder structures until it is interrupted
+# It listens on localhost on "port", or on the Unix socket "socket_path" if one is given
+# If "refresh" is greater than 0 the state is refreshed every "refresh" seconds, see refresh_queries above
+def serve_queries(state, args):
+    if args.socket is not None:
+        # A socket left behind by a server that was killed is removed, anything else is left alone
+        if os.path.exists(args.socket):
+            if not stat.S_ISSOCK(os.stat(args.socket).st_mode):
+                print("Error: %s exists and is not a socket" % args.socket)
+                return
+            os.remove(args.socket)
+        server = ThreadingUnixHTTPServer(args.socket, QueryHandler)
+        print("\nAnswering lookups on " + args.socket)
+    else:
+        server = ThreadingHTTPServer(('127.0.0.1', args.port), QueryHandler)
+        print("\nAnswering lookups on http://127.0.0.1:%s" % server.server_address[1])
+    server.state = state
     
-    # Move empty directories
-#    move_empty_dirs()
+    if args.refresh > 0:
+        threading.Thread(target=refresh_queries, args=(server, args, args.refresh), daemon=True).start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nStopping")
+    finally:
+        server.server_close()
+        if args.socket is not None and os.path.exists(args.socket) and stat.S_ISSOCK(os.stat(args.socket).st_mode):
+            os.remove(args.socket)
+
+# The functions below run the script from the command line, see parse_arguments and run_phases
+# The results of each stage are cached in the cache directory with a fingerprint of its inputs: the size and modification time
+#   of its input files, its options and the fingerprints of the stages it depends on. A stage whose fingerprint has not changed
+#   since the last run is not run again, its results are read from the cache
+
+# This function returns a (name, size, modification time) tuple for each file in a list, with None values for files that don't exist
+# Only the file system is asked, the files are not read, so a fingerprint is cheap to check again, eg by refresh_queries above
+def file_stats(names):
+    stats = []
+    for name in names:
+        try:
+            st = os.stat(name)
+            stats.append((name, st.st_size, st.st_mtime_ns))
+        except OSError:
+            stats.append((name, None, None))
+    return stats
 
+# This function returns the fingerprint of a stage from a description of its inputs, see file_stats above
+def artifact_key(*inputs):
+    return hashlib.md5(repr(inputs).encode('utf-8')).hexdigest()
+
+# This function saves the results of a stage to <stage>.pickle in the cache directory with the fingerprint "key"
+# The file is written under a temporary name first, so an interrupted run never leaves a partial file behind
+def save_artifact(stage, key, results):
+    if not os.path.isdir(cache_dir_name):
+        os.makedirs(cache_dir_name)
+    name = cache_dir_name + '/' + stage + '.pickle'
+    with open(name + '.tmp', 'wb') as f:
+        pickle.dump(key, f, protocol=pickle.HIGHEST_PROTOCOL)
+        pickle.dump(results, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(name + '.tmp', name)
+
+# This function reads the results of a stage saved by save_artifact above
+# The fingerprint is stored before the results, so results with a different fingerprint are not read
+# It returns the results, or None if there are no cached results with the fingerprint "key"
+def load_artifact(stage, key):
+    name = cache_dir_name + '/' + stage + '.pickle'
+    if not os.path.isfile(name):
+        return None
+    try:
+        with open(name, 'rb') as f:
+            if pickle.load(f) != key:
+                return None
+            results = pickle.load(f)
+    # Artifacts saved by an older version may hold objects that no longer unpickle
+    except (OSError, EOFError, AttributeError, pickle.UnpicklingError):
+        return None
+    return results
+
+# This function copies the folder structures of a previous state before the analysis marks their directories with errors, so
+#   the state the server is answering from is not changed while it is read. The lists of tifs are shared, they are not changed
+def copy_folder_structures(folder_structures):
+    return {indir: {directory: dict(entry) for directory, entry in folder_structures[indir].items()} for indir in folder_structures}
+
+# This function returns the names of the csv files written by the analyze phase, see run_phases below
+# If "gzipped" is set the names of the gzip compressed files are returned, see open_report above
+def report_file_names(indirs, near_duplicates=None, gzipped=False):
+    names = []
+    for indir in indirs:
+        for file_name in ['directories_injested.csv', 'directories_injested_files.csv', 'directories_with_duplicates.csv',
+                          'directories_with_duplicates_files.csv', 'duplicate_trees.csv']:
+            names.append('Results/' + indir + '/' + file_name)
+        if near_duplicates is not None:
+            names.append('Results/' + indir + '/near_duplicate_directories.csv')
+    if gzipped:
+        names = [name + '.gz' for name in names]
+    return names
+
+# This function returns the fingerprint of the local phase, see run_phases below
+# With --compute the hash cache is part of the fingerprint, so the results record which checksums were computed
+def local_artifact_key(indirs, args):
+    return artifact_key('local', file_stats(["Results/" + indir + "/folder_structure.csv" for indir in indirs]),
+                        file_stats(["Local_Checksums/" + file_name for file_name in local_list_file_names]), args.compact,
+                        args.compute, file_stats([hash_cache_file_name]) if args.compute else None, args.prefilter)
+
+# The phases run_phases can run, in the order they are run
+phase_names = ['scan', 'verify', 'bdr', 'local', 'analyze', 'move', 'serve']
+
+# The moves the move phase can make, in the order they are made
+move_names = ['artifacts', 'injested', 'duplicates', 'trees', 'empty']
+
+# This function reads the command line arguments, run "python run.py --help" for a description of each argument
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(description="Find tifs in the DPS file system that are already in the BDR or are duplicated, and move them.")
+    parser.add_argument('phases', nargs='*', metavar='phase',
+                        help="The phases to run: " + ", ".join(phase_names) + ". The phases a phase depends on are read from the cache or run as well. Default: scan bdr local analyze")
+    parser.add_argument('--move', action='append', default=[], choices=move_names,
+                        help="A move for the move phase to make, can be given more than once")
+    parser.add_argument('--dry-run', action='store_true', help="Only write move plans to the journal directory, don't move anything")
+    parser.add_argument('--workers', type=int, default=4,
+                        help="The number of processes used to hash files and analyze top level directories, 0 to analyze them in this process. Default: 4")
+    parser.add_argument('--threads', type=int, default=8, help="The number of threads used to read the file system and move files. Default: 8")
+    parser.add_argument('--full', action='store_true', help="List every directory again instead of only directories that changed")
+    parser.add_argument('--per-store', action='store_true', help="Scan and read local checksums with each top level directory in its own process")
+    parser.add_argument('--maintain', action='store_true', help="Move tif artifacts and empty directories while scanning")
+    parser.add_argument('--compute', action='store_true', help="Hash tifs missing from the local checksum files")
+    parser.add_argument('--prefilter', action='store_true',
+                        help="Hash tifs missing from the local checksum files that share their size and first and last bytes with another tif")
+    parser.add_argument('--no-compact', dest='compact', action='store_false', help="Keep checksums as hex strings instead of 16 byte digests")
+    parser.add_argument('--near-duplicates', type=float, metavar='THRESHOLD',
+                        help="Also list directories that share at least this share of their tifs, eg 0.9")
+    parser.add_argument('--top', type=int, metavar='N',
+                        help="Only list the N directories with the highest share of injested or duplicate tifs, and the N largest duplicate trees")
+    parser.add_argument('--gzip', action='store_true', help="Write the csv files of the analyze phase gzip compressed")
+    parser.add_argument('--summary', action='append', default=[], metavar='DIRECTORY',
+                        help="Print how much of a directory tree is injested or duplicated, can be given more than once")
+    parser.add_argument('--no-cache', action='store_true', help="Run every stage again instead of reading cached results")
+    parser.add_argument('--resume', metavar='JOURNAL', help="Finish an interrupted move plan and exit")
+    parser.add_argument('--rollback', metavar='JOURNAL', help="Undo a move plan and exit")
+    parser.add_argument('--bandwidth', type=float, default=20, metavar='MB',
+                        help="The megabytes per second the verify phase may read, 0 for no limit. Default: 20")
+    parser.add_argument('--sample', type=float, default=1.0, metavar='FRACTION',
+                        help="The share of the tifs of each directory the verify phase checks, eg 0.05. Default: 1")
+    parser.add_argument('--seed', type=int, help="Seed the sample of the verify phase, to check the same tifs on every run")
+    parser.add_argument('--port', type=int, default=8765, help="The localhost port the serve phase listens on. Default: 8765")
+    parser.add_argument('--socket', metavar='PATH', help="A Unix socket for the serve phase to listen on instead of a port")
+    parser.add_argument('--refresh', type=float, default=300, metavar='SECONDS',
+                        help="How often the serve phase refreshes the checksums and folder structures, 0 to never refresh. Default: 300")
+    parser.add_argument('--profile', type=float, nargs='?', const=0.01, metavar='SECONDS',
+                        help="Sample the stacks of every thread every SECONDS seconds (default 0.01) and save them with the metrics")
+    args = parser.parse_args(argv)
+    
+    if len(args.phases) == 0:
+        args.phases = ['scan', 'bdr', 'local', 'analyze']
+    for phase in args.phases:
+        if phase not in phase_names:
+            parser.error("invalid phase: %s (choose from %s)" % (phase, ", ".join(phase_names)))
+    if args.workers < 0:
+        parser.error("--workers can't be negative")
+    for move in ['duplicates', 'trees']:
+        if 'injested' in args.move and move in args.move:
+            parser.error("--move injested and --move %s can't be used together" % move)
+    if len(args.move) > 0 and 'move' not in args.phases:
+        args.phases.append('move')
+    # These moves are planned from the folder structures, so the share is scanned first in case changes were made since the
+    #   last scan. Otherwise tifs added since then would be moved without their checksums being checked
+    if len(set(args.move) & {'injested', 'duplicates', 'trees'}) > 0 and 'scan' not in args.phases:
+        args.phases.insert(0, 'scan')
+    return args
+
+# This function runs the phases selected on the command line, see parse_arguments above and run_stages below
+# Each stage is measured with start_stage and end_stage above, and the metrics of the run are saved with save_metrics
+# The file system functions replaced for a stage are restored even if the stage fails
+def run_phases(args):
+    metrics = {'started': time.strftime('%Y%m%d_%H%M%S'), 'start': time.perf_counter(), 'arguments': vars(args),
+               'stages': [], 'profiler': None, 'originals': None}
+    if args.profile is not None:
+        metrics['profiler'] = SamplingProfiler(args.profile)
+        metrics['profiler'].start()
+    state = None
+    try:
+        state = run_stages(args, metrics)
+    finally:
+        if metrics['originals'] is not None:
+            stop_counting_file_system_calls(metrics['originals'])
+            metrics['originals'] = None
+        if metrics['profiler'] is not None:
+            metrics['profiler'].stop()
+        save_metrics(metrics)
+    
+    # The server runs after the file system functions are restored, so its lookups and refreshes are not counted
+    if 'serve' in args.phases and state is not None:
+        serve_queries(state, args)
+
+# This function runs the stages of the phases selected on the command line
+#   scan - Read the file system with get_folder_structures, process_stores or maintain_folder_structures. Without it the
+#          folder structures saved by the last scan are used
+#   verify - Hash a sample of the tifs again at a capped rate and list the ones that don't match their local checksum,
+#            see verify_checksums above. Their directories are marked as errors and are not moved
+#   bdr - Open the BDR digest index, compiling it if the BDR checksum file changed
+#   local - Match the local checksums to the tifs and find the checksums of possible duplicates
+#   analyze - Write the collision and duplicate tree csv files
+#   move - Make the moves given with --move
+#   serve - Load the data for serve_queries above, which run_phases starts once the stages are done
+# It returns a dictionary with the loaded data: state, see serve_queries above
+# If the "previous" state is given, results whose fingerprint has not changed are taken from it instead of the cache
+def run_stages(args, metrics, previous=None):
+    if args.resume is not None:
+        stage = start_stage(metrics, 'resume')
+        resume_move_plan(args.resume, args.threads)
+        end_stage(metrics, stage)
+        return
+    if args.rollback is not None:
+        stage = start_stage(metrics, 'rollback')
+        rollback_move_plan(args.rollback, args.threads)
+        end_stage(metrics, stage)
+        return
+    
+    phases = set(args.phases)
+    indirs = os.listdir('Results')
+    analyze = len(phases & {'analyze', 'move', 'serve'}) > 0 or len(args.summary) > 0
+    
+    # Open the index that caches the CSV files, CSV files that changed since the last run are imported again
+    index = open_index()
+    
+    folder_structures = None
+    local_checksums_fwd = None
+    local_checksums_bwd = None
+    
+    # Get the folder structure, only directories that changed since the last run are read again unless --full is given
+    if 'scan' in phases:
+        stage = start_stage(metrics, 'scan')
+        if args.maintain:
+            folder_structures = maintain_folder_structures(False, args.threads, args.dry_run, index)
+        # Each top level directory needs a worker process, so with --workers 0 they are scanned in this process instead
+        elif args.per_store and args.workers > 0:
+            folder_structures, local_checksums_fwd, local_checksums_bwd = process_stores(args.workers, False, args.threads, not args.full, args.compact, index, args.compute)
+        else:
+            folder_structures = get_folder_structures(False, False, args.threads, not args.full, index)
+        end_stage(metrics, stage, sum(len(folder_structures[indir]) for indir in folder_structures))
+    
+    # Check that the local checksums still match the tifs
+    if 'verify' in phases:
+        if folder_structures is None:
+            stage = start_stage(metrics, 'read folder structures')
+            folder_structures = get_folder_structures(False, True, args.threads, False, index)
+            end_stage(metrics, stage, sum(len(folder_structures[indir]) for indir in folder_structures))
+        stage = start_stage(metrics, 'verify')
+        verified = verify_checksums(folder_structures, args.bandwidth*1024*1024, args.threads, args.sample, args.seed, index)
+        end_stage(metrics, stage, verified)
+    
+    # Get local checksums, and with --prefilter the checksums of tifs missing from the local checksum files that could be duplicates of other tifs
+    if 'local' in phases or analyze:
+        local_key = local_artifact_key(indirs, args)
+        if previous is not None and previous['local_key'] == local_key:
+            cached = previous['folder_structures'], previous['local_checksums_fwd'], previous['local_checksums_bwd']
+        else:
+            cached = None if args.no_cache else load_artifact('local', local_key)
+        if cached is not None:
+            print("\nUsing cached local checksums")
+            folder_structures, local_checksums_fwd, local_checksums_bwd = cached
+        else:
+            if folder_structures is None:
+                stage = start_stage(metrics, 'read folder structures')
+                folder_structures = get_folder_structures(False, True, args.threads, False, index)
+                end_stage(metrics, stage, sum(len(folder_structures[indir]) for indir in folder_structures))
+            if local_checksums_fwd is None:
+                stage = start_stage(metrics, 'local checksums')
+                local_checksums_fwd, local_checksums_bwd = get_local_checksums(folder_structures, args.compute, args.workers, index, args.compact)
+                end_stage(metrics, stage, len(local_checksums_bwd))
+            if args.prefilter:
+                stage = start_stage(metrics, 'missing checksums')
+                find_missing_checksums(folder_structures, local_checksums_fwd, local_checksums_bwd, args.compact, workers=args.threads)
+                end_stage(metrics, stage, len(local_checksums_bwd))
+            # The folder structures may have been scanned just now if they were never saved
+            local_key = local_artifact_key(indirs, args)
+            save_artifact('local', local_key, (folder_structures, local_checksums_fwd, local_checksums_bwd))
+    
+    # Get BDR checksums
+    # The BDR checksum file is compiled into a memory-mapped index the first time it is read after it changes
+    if 'bdr' in phases or analyze:
+        stage = start_stage(metrics, 'bdr checksums')
+        bdr_checksums = open_bdr_index()
+        end_stage(metrics, stage, len(bdr_checksums))
+    
+    # Generate the bdr and local collision and duplicate tree csv files
+    # The directories with errors are cached along with the injested and duplicate counts, since the move phase skips them
+    if analyze:
+        mismatch_files = ["Results/" + indir + "/" + mismatch_file_name for indir in indirs]
+        analyze_key = artifact_key('analyze', local_key, file_stats(['BDR_Checksums/checksum_data_3.csv']), file_stats(mismatch_files), args.near_duplicates, args.top, args.gzip)
+        reports = report_file_names(indirs, args.near_duplicates, args.gzip)
+        
+        if previous is not None and previous['analyze_key'] == analyze_key:
+            cached = previous['directory_counts'], None, previous['report_stats']
+        else:
+            cached = None if args.no_cache else load_artifact('analyze', analyze_key)
+        # A new state is built instead of changing the previous one, which the server may still be reading
+        reused = previous is not None and folder_structures is previous['folder_structures']
+        if cached is not None and cached[2] == file_stats(reports):
+            print("\nUsing cached analysis, the csv files are up to date")
+            directory_counts, errors, report_stats = cached
+            # The errors are already marked in the folder structures of a previous state
+            if errors is not None:
+                if reused:
+                    folder_structures = copy_folder_structures(folder_structures)
+                for indir in errors:
+                    for directory in errors[indir]:
+                        folder_structures[indir][directory]['error'] = 1
+        else:
+            if reused:
+                folder_structures = copy_folder_structures(folder_structures)
+            mark_mismatched_directories(folder_structures, read_checksum_mismatches(indirs))
+            stage = start_stage(metrics, 'bdr and local collisions')
+            directory_counts = analyze_dir_collisions(folder_structures, local_checksums_fwd, local_checksums_bwd, bdr_checksums, args.workers, args.top, args.gzip)
+            end_stage(metrics, stage, len(local_checksums_bwd))
+            stage = start_stage(metrics, 'duplicate trees')
+            analyze_duplicate_trees(folder_structures, local_checksums_bwd, args.top, args.gzip)
+            end_stage(metrics, stage, sum(len(folder_structures[indir]) for indir in folder_structures))
+            if args.near_duplicates is not None:
+                stage = start_stage(metrics, 'near duplicates')
+                analyze_near_duplicate_directories(folder_structures, local_checksums_bwd, args.near_duplicates, gzipped=args.gzip)
+                end_stage(metrics, stage, sum(len(folder_structures[indir]) for indir in folder_structures))
+            
+            errors = dict()
+            for indir in indirs:
+                errors[indir] = [directory for directory in folder_structures[indir] if folder_structures[indir][directory]['error']]
+            report_stats = file_stats(reports)
+            save_artifact('analyze', analyze_key, (directory_counts, errors, report_stats))
+        
+        folder_trees = None
+        if len(args.summary) > 0:
+            folder_trees = build_folder_trees(folder_structures, directory_counts)
+        for directory in args.summary:
+            print_folder_summary(folder_trees, directory)
+    
+    # Move files, see move_names above for the order of the moves
+    # Moves write their plan to the journal directory, use --resume or --rollback with the journal to finish or undo an interrupted run
+    if 'move' in phases:
+        if len(args.move) == 0:
+            print("\nNo moves given, use --move to select them")
+        for move in move_names:
+            if move not in args.move:
+                continue
+            stage = start_stage(metrics, 'move ' + move)
+            if move == 'artifacts':
+                for indir in indirs:
+                    print("\nWorking on " + indir)
+                    move_tiff_artifacts(indir, args.dry_run, args.threads)
+            elif move == 'injested':
+                move_injested_directories(folder_structures, local_checksums_bwd, bdr_checksums, args.dry_run, args.threads, read_checksum_mismatches(indirs))
+            elif move == 'duplicates':
+                move_duplicate_directories(local_checksums_bwd, folder_structures, args.dry_run, args.threads)
+            elif move == 'trees':
+                move_duplicate_trees(local_checksums_bwd, folder_structures, args.dry_run, args.threads)
+            elif move == 'empty':
+                move_empty_dirs(args.dry_run, args.threads)
+            end_stage(metrics, stage)
+    
+    state = None
+    if analyze:
+        state = {'loaded': time.strftime('%Y-%m-%d %H:%M:%S'), 'folder_structures': folder_structures,
+                 'local_checksums_fwd': local_checksums_fwd, 'local_checksums_bwd': local_checksums_bwd, 'bdr_checksums': bdr_checksums,
+                 'directory_counts': directory_counts, 'folder_trees': folder_trees, 'local_key': local_key, 'analyze_key': analyze_key, 'report_stats': report_stats}
+    
+    return state
+
+
+if __name__ == '__main__':    
+    
+    # Run the phases given on the command line, eg "python run.py analyze" to only write the csv files again
+    # Run "python run.py --help" for the phases and options
+    run_phases(parse_arguments(sys.argv[1:]))
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Round-trip tests of the move plans in run.py: run, resume and roll back a plan on a temporary tree
+
+Run with "python -m pytest tests" or "python -m unittest discover tests" from the repository
+"""
+
+import os
+import sys
+import csv
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import run
+
+
+# This function returns every directory and file under "top" with the contents of each file, to compare trees
+def snapshot(top):
+    entries = dict()
+    for root, dirs, files in os.walk(top):
+        for directory in dirs:
+            entries[os.path.relpath(os.path.join(root, directory), top)] = None
+        for file in files:
+            with open(os.path.join(root, file), 'rb') as f:
+                entries[os.path.relpath(os.path.join(root, file), top)] = f.read()
+    return entries
+
+# This function returns the latest status of each step of a journal
+def journal_status(journal_path):
+    return run.read_journal(journal_path)[1]
+
+
+class MovePlanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.share_root = run.share_root
+        self.base = tempfile.mkdtemp()
+        os.chdir(self.base)
+        run.share_root = self.base + '/share/'
+        for filepath in ['CDI_STORE_01/proj/sub/img0.tif', 'CDI_STORE_01/proj/sub/img1.tif', 'CDI_STORE_01/other/img2.tif']:
+            os.makedirs(os.path.dirname(run.share_root + filepath), exist_ok=True)
+            with open(run.share_root + filepath, 'wb') as f:
+                f.write(filepath.encode())
+        self.original = snapshot(run.share_root)
+
+        # Move the tifs of CDI_STORE_01/proj/sub and remove the directory, like move_injested_directories does
+        moved = run.share_root + 'MOVED/CDI_STORE_01/proj/sub'
+        self.plan = [('makedirs', moved, ""),
+                     ('rename', run.share_root + 'CDI_STORE_01/proj/sub/img0.tif', moved + '/img0.tif'),
+                     ('rename', run.share_root + 'CDI_STORE_01/proj/sub/img1.tif', moved + '/img1.tif'),
+                     ('rmdir', run.share_root + 'CDI_STORE_01/proj/sub', "")]
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        run.share_root = self.share_root
+        shutil.rmtree(self.base)
+
+    # This writes a journal for the plan as execute_move_plan does, and appends the given (step, status) rows
+    # A (step, 'creating', directory) row records a directory created by a makedirs step
+    def write_journal(self, rows):
+        os.makedirs(run.journal_dir_name, exist_ok=True)
+        journal_path = run.journal_dir_name + '/test_journal.csv'
+        with open(journal_path, 'w', newline='') as journal_file:
+            writer = csv.writer(journal_file, delimiter=',')
+            writer.writerow(["Step", "Status", "Operation", "Source", "Destination", "Message"])
+            for step_id, (operation, source, destination) in enumerate(self.plan):
+                writer.writerow([step_id, 'planned', operation, source, destination, ""])
+            for row in rows:
+                if row[1] == 'creating':
+                    writer.writerow([row[0], 'creating', 'makedirs', row[2], "", ""])
+                else:
+                    writer.writerow([row[0], row[1]] + list(self.plan[row[0]]) + [""])
+        return journal_path
+
+    def test_run_and_roll_back(self):
+        journal_path, failed = run.execute_move_plan(self.plan, 'test', 2)
+        self.assertEqual(failed, 0)
+        self.assertFalse(os.path.exists(run.share_root + 'CDI_STORE_01/proj/sub'))
+        self.assertTrue(os.path.isfile(run.share_root + 'MOVED/CDI_STORE_01/proj/sub/img0.tif'))
+        self.assertEqual(set(journal_status(journal_path).values()), {'done'})
+
+        run.rollback_move_plan(journal_path, 2)
+        self.assertEqual(snapshot(run.share_root), self.original)
+        self.assertEqual(set(journal_status(journal_path).values()), {'undone'})
+
+    def test_every_step_is_started_before_it_is_done(self):
+        missing = run.missing_directories(self.plan[0][1])
+        journal_path, failed = run.execute_move_plan(self.plan, 'test', 2)
+        with open(journal_path, newline='') as journal_file:
+            rows = list(csv.reader(journal_file, delimiter=','))[1:]
+        for step_id in range(len(self.plan)):
+            statuses = [row[1] for row in rows if row[0] == str(step_id) and row[1] != 'creating']
+            self.assertEqual(statuses, ['planned', 'started', 'done'])
+        created = [row[3] for row in rows if row[1] == 'creating']
+        self.assertEqual(sorted(created), sorted(missing))
+        self.assertIn(run.share_root + 'MOVED', created)
+
+    def test_roll_back_keeps_existing_directories(self):
+        os.makedirs(run.share_root + 'MOVED/CDI_STORE_01')
+        journal_path, failed = run.execute_move_plan(self.plan, 'test', 2)
+        run.rollback_move_plan(journal_path, 2)
+        self.assertTrue(os.path.isdir(run.share_root + 'MOVED/CDI_STORE_01'))
+        self.assertFalse(os.path.exists(run.share_root + 'MOVED/CDI_STORE_01/proj'))
+        self.assertEqual(set(journal_status(journal_path).values()), {'undone'})
+
+    # The run was killed after the first rename took effect but before it was recorded as done
+    def interrupt(self):
+        created = [(0, 'creating', directory) for directory in run.missing_directories(self.plan[0][1])]
+        os.makedirs(self.plan[0][1])
+        os.rename(self.plan[1][1], self.plan[1][2])
+        return self.write_journal(created + [(0, 'started'), (0, 'done'), (1, 'started')])
+
+    def test_resume_after_interrupted_rename(self):
+        journal_path = self.interrupt()
+        self.assertEqual(run.resume_move_plan(journal_path, 2), 0)
+        self.assertEqual(set(journal_status(journal_path).values()), {'done'})
+        self.assertFalse(os.path.exists(run.share_root + 'CDI_STORE_01/proj/sub'))
+
+        run.rollback_move_plan(journal_path, 2)
+        self.assertEqual(snapshot(run.share_root), self.original)
+
+    def test_roll_back_interrupted_rename(self):
+        journal_path = self.interrupt()
+        run.rollback_move_plan(journal_path, 2)
+        self.assertEqual(snapshot(run.share_root), self.original)
+        self.assertEqual(journal_status(journal_path)[1], 'undone')
+
+
+if __name__ == '__main__':
+    unittest.main()